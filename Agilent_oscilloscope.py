@@ -3,16 +3,28 @@ import pyvisa as visa
 import matplotlib.pyplot as plt
 import numpy as np
 
+from scope_timebase import Timebase
+from simulated_instruments import simulation_enabled, SimulatedAgilentSession
+from scpi_trace import traced
+
+preamble_fields=['format','type','points','count','xinc','xorg','xref','yinc','yorg','yref']
+
 class agilent_mso6104A():
 
-	def __init__(self,default_channel=1):
-		rm=visa.ResourceManager()
+	def __init__(self,default_channel=1,simulate=None,trace=None):
 		self.data_dict={}
-		self.device=rm.open_resource("USB0::0x0957::0x1754::MY44000509::INSTR")
+		if simulation_enabled(simulate):
+			self.device=SimulatedAgilentSession()
+		else:
+			rm=visa.ResourceManager()
+			self.device=rm.open_resource("USB0::0x0957::0x1754::MY44000509::INSTR")
+		self.device=traced(self.device,'agilent',trace)	# Opt-in, see scpi_trace
 		print(self.device.query('*IDN?'))
 		#self.device.write('OUTPut1:STAT OFF')
 		self.default_channel=default_channel
 		self.device.write(':WAVEFORM:FORMAT WORD')
+		self.preamble_cache={}
+		self.timebase=None
 
 	def take_data(self):
 		self.device.write(':SINGLE')
@@ -25,40 +37,55 @@ class agilent_mso6104A():
 			self.device.write(':ACQUIRE:TYPE HRESOLUTION')
 		else:
 			self.device.write(':ACQUIRE:TYPE NORMAL')
+		self.clear_preamble()
+		
+	# Preamble fields: format,type,points,count,xinc,xorg,xref,yinc,yorg,yref
+	# Cached per source, cleared whenever scale, offset or timebase change
+	def get_preamble(self,channel):
+		if type(channel)==int or type(channel)==float:
+			channel='CHANNEL'+str(channel)
+		if channel not in self.preamble_cache:
+			self.device.write(':WAVEFORM:SOURCE '+channel)
+			values=[float(x) for x in self.device.query(':WAVEFORM:PREAMBLE?').split(',')]
+			self.preamble_cache[channel]=dict(zip(preamble_fields,values))
+		return self.preamble_cache[channel]
+
+	def clear_preamble(self):
+		self.preamble_cache={}
+		self.timebase=None
+		
+	# Axis of the default channel record, rebuilt only after the preamble cache is cleared
+	def get_timebase(self,channel=None):
+		if not channel:
+			channel=self.default_channel
+		if self.timebase is None:
+			pre=self.get_preamble(channel)
+			self.timebase=Timebase(pre['points'],pre['xinc'],pre['xorg']-pre['xref']*pre['xinc'])
+		return self.timebase
 		
 	def read_waveform(self,channel, plot_with_clipped=False):
 		if type(channel)==int or type(channel)==float:
 			channel='CHANNEL'+str(channel)
 		#self.device.write(':WAVEFORM:FORMAT WORD')
-		clipped_low=False
-		clipped_high=False
+		pre=self.get_preamble(channel)
 		self.device.write(':WAVEFORM:SOURCE '+channel)
 		self.device.write(':WAVEFORM:DATA?')
 		all_data=self.device.read_raw()
-		data=all_data[10:].strip()
-		yinc=float(self.device.query(':WAVEFORM:YINCREMENT?'))
-		yorg=float(self.device.query(':WAVEFORM:YORIGIN?'))
-		yref=float(self.device.query(':WAVEFORM:YREFERENCE?'))
-		result=[]
-		unclipped_result=[]
-		for i in range(0,len(data),2):
-			if data[i:i+2]==b'\x01\x00':
-				clipped_low=True
-			if data[i:i+2]==b'\xff\x00':
-				clipped_high=True
-			if plot_with_clipped and (data[i:i+2]==b'\xff\x00' or data[i:i+2]==b'\x01\x00'):
-				result.append(None)
-				datapoint=data[i]*256+data[i+1]
-				unclipped_result.append(round(((datapoint-yref)*yinc+yorg),11))
-			else:
-				datapoint=data[i]*256+data[i+1]
-				result.append(round(((datapoint-yref)*yinc+yorg),11))
-				unclipped_result.append(round(((datapoint-yref)*yinc+yorg),11))
+		header_len=int(all_data[1:2])			# Block header #<n><n digits of length>
+		data_len=int(all_data[2:2+header_len])
+		data=all_data[2+header_len:2+header_len+data_len]
+		raw=np.frombuffer(data[:len(data)//2*2],dtype='>u2')
+		low=raw==0x0100
+		high=raw==0xff00
+		clipped_low=bool(low.any())
+		clipped_high=bool(high.any())
+		unclipped_result=np.round((raw-pre['yref'])*pre['yinc']+pre['yorg'],11)
 		
 		if plot_with_clipped:
+			result=np.where(low|high,np.nan,unclipped_result)
 			return result,(clipped_low,clipped_high),unclipped_result
 		else:
-			return result,(clipped_low,clipped_high)
+			return unclipped_result,(clipped_low,clipped_high)
 		
 	def plot_waveform(self,channel=None):
 		if not channel:
@@ -75,6 +102,7 @@ class agilent_mso6104A():
 		if not channel:
 			channel=self.default_channel
 		self.device.write(':CHANNEL'+str(channel)+':SCALE '+str(scale)+units)
+		self.clear_preamble()
 		return self.device.query(':CHANNEL'+str(channel)+':SCALE?')
 	
 	def get_range(self,channel=None):
@@ -95,15 +123,18 @@ class agilent_mso6104A():
 		if units=='mV':
 			current_offset*=1000
 		self.device.write(':CHANNEL'+str(channel)+':OFFSET '+str(current_offset+delta)+units)
+		self.clear_preamble()
 	
 	def set_offset(self,val,units='V',channel=None):
 		self.device.write(':CHANNEL'+str(channel)+':OFFSET '+str(val)+units)
+		self.clear_preamble()
 		
 	def save_setup(self):
 		self.device.query('SAVE:SETUP:START 0')
 		
 	def recall_setup(self):
 		self.device.query('RECALL:SETUP:START 0')
+		self.clear_preamble()
 	
 	def get_scale(self,channel=None):
 		if not channel:
@@ -112,12 +143,14 @@ class agilent_mso6104A():
 		
 	def set_timescale(self,value,units='ms'):
 		self.device.write(':TIMEBASE:SCALE '+str(value)+' '+units)
+		self.clear_preamble()
 		
 	def get_timescale(self):
 		return float(self.device.query(':TIMEBASE:SCALE?'))
 		
 	def set_timedelay(self,delay,units='ms'):
 		self.device.write(':TIMEBASE:POSITION '+str(delay)+' '+units)
+		self.clear_preamble()
 	
 def get_Y_axis(osc):
     while True:
@@ -130,9 +163,7 @@ def get_Y_axis(osc):
     return res
 
 def get_X_axis(osc):
-    step=osc.get_timescale()/100
-    times=np.arange(0,1000*step,step)
-    return times
+    return osc.get_timebase().axis
 
 if __name__=='__main__':
     a=agilent_mso6104A()
@@ -3,6 +3,8 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 import sys,traceback,time,random,os
 from motion_stage_driver import MotionStageController
+from raster_scan import RasterScan,BacklashModel,open_scan_file,get_amplitude
+from live_map import MapRenderer
 import numpy as np
 from collections import defaultdict
 
@@ -26,6 +28,10 @@ if not os.path.exists(cache_dir):
 if not os.path.exists(data_dir):
     os.makedirs(data_dir)
 
+# Carries position updates of the motion stage controller (any thread) to the GUI thread
+class PositionSignals(QObject):
+	position_changed = pyqtSignal(int,int)
+	
 class WorkerSignals(QObject):
 	finished = pyqtSignal()
 	error = pyqtSignal(tuple)
@@ -69,6 +75,38 @@ class Worker(QRunnable):
 			self.wait()
 
 
+# Thread-safe front end of MapRenderer. set_map may be called from the scan worker, it keeps
+# only the latest map and signals the GUI thread, which draws at most max_fps frames a second.
+# The last map of a scan is always drawn.
+class LiveMapView(QObject):
+	frame_ready = pyqtSignal()
+	
+	def __init__(self,figure,canvas,max_fps=10):
+		super().__init__()
+		self.renderer=MapRenderer(figure,canvas,max_fps)
+		self.lock=threading.Lock()
+		self.pending=None
+		self.scheduled=False
+		self.frame_ready.connect(self.draw) #queued, self lives in the GUI thread
+		
+	def set_map(self,data,l):
+		with self.lock:
+			self.pending=(data,l)
+			if self.scheduled:
+				return
+			self.scheduled=True
+		self.frame_ready.emit()
+		
+	def draw(self):
+		wait=self.renderer.min_interval-(time.perf_counter()-self.renderer.last_draw)
+		if wait>0:
+			QTimer.singleShot(int(1000*wait)+1,self.draw)
+			return
+		with self.lock:
+			data,l=self.pending
+			self.scheduled=False
+		self.renderer.draw(data,l)
+		
 class TwoDScanParamters(QWidget):
 	def __init__(self,*args,**kwargs):
 		super().__init__(*args,**kwargs)
@@ -137,9 +175,24 @@ class TwoDScan(QWidget):
 		self.canvas.setFixedWidth(300)
 		self.canvas.setFixedHeight(300)
 		self.toolbar = NavigationToolbar(self.canvas, self)
+		self.max_fps=10 #live map redraws per second
+		self.live_map=LiveMapView(self.figure,self.canvas,self.max_fps)
 		self.button_plot = QPushButton('Run')
+		self.button_plot.clicked.connect(self.start_scan)
+		self.button_backlash = QPushButton('Calibrate backlash')
+		self.button_backlash.clicked.connect(self.start_calibration)
 		self.twodscan_parameters=TwoDScanParamters()
 		self.event_stop=threading.Event()
+		self.output_dtype=np.float64 #np.float32 halves the size of the scan file
+		self.pipelined=True #readout and saving of a pixel overlap the move to the next
+		self.serpentine=True #every other row scanned backwards, no return trips
+		self.backlash=BacklashModel(os.path.join(cache_dir,'backlash.json'))
+		self.adaptive=False #coarse raster refined only around edges, see RasterScan.run_adaptive
+		self.adaptive_coarse=8 #pixels between the points of the coarse raster
+		self.adaptive_threshold=0.2 #fraction of the amplitude range that makes a cell refined
+		self.check_adaptive = QCheckBox('Adaptive')
+		self.check_adaptive.setChecked(self.adaptive)
+		self.check_adaptive.toggled.connect(self.set_adaptive)
 		
 		self.threadpool = QThreadPool()
 		
@@ -147,26 +200,36 @@ class TwoDScan(QWidget):
 		layout.addWidget(self.toolbar,Qt.AlignCenter)
 		layout.addWidget(self.canvas,Qt.AlignCenter)
 		layout.addWidget(self.button_plot,Qt.AlignCenter)
+		layout.addWidget(self.button_backlash,Qt.AlignCenter)
+		layout.addWidget(self.check_adaptive,Qt.AlignCenter)
 		layout.addWidget(self.twodscan_parameters,Qt.AlignCenter)
 
-	def plot(self,data,l):
-		ax = self.figure.add_subplot(111)
-		ax.clear()
-		ax.imshow(data,cmap='jet')
-		ax.set_title('L: '+str(l))
-		self.canvas.draw()
+	def plot(self,data,l): #called from the scan worker
+		self.live_map.set_map(data,l)
 
 	def get_amplitude(self,waveform):
-		return np.mean(waveform[0:100])-np.min(waveform)
+		return get_amplitude(waveform)
 
+	def set_adaptive(self,checked):
+		self.adaptive=checked
+		
 	def thread_complete(self):
 		self.button_plot.setEnabled(True)
+		self.button_backlash.setEnabled(True)
 		
 	def stop(self):
 		self.event_stop.set()
 		print(Fore.RED+'Scan stopped!',Style.RESET_ALL)
-	
-		self.button_plot.setEnabled(False)
+		
+	def start_scan(self):
+		self.button_plot.setEnabled(False) #GUI thread, re-enabled by thread_complete
+		self.button_backlash.setEnabled(False)
+		worker=Worker(self.run_scan)
+		worker.signals.finished.connect(self.thread_complete)
+		self.threadpool.start(worker)
+		
+	def run_scan(self,progress_callback):
+		self.event_stop.clear()
 		
 		spaces,h_return,v_return=self.get_scanning_space()
 		if not spaces:
@@ -182,64 +245,48 @@ class TwoDScan(QWidget):
 			#Move to beginning of scan
 			udist={}
 			for k in spaces.keys():
-				udist[k]=self.m.get_position(self.m.devices[k])[1]
+				udist[k]=self.m.cached_position(self.m.devices[k])[1]
 				#self.m.move(self.m.devices[k],spaces[k],udist[k])
 			channels=self.twodscan_parameters.channels
-			final_data_form=np.zeros((1,1003,3)).astype(np.float)#1000 scope datapoints and 3 for position
-			counter=0
-			data_file=0
-			img_data=np.zeros((len(spaces['V']),len(spaces['H'])))
-			for l in spaces['L']:
-				self.m.move(self.m.devices['L'],l,udist['L'])
-				for v in spaces['V']:
-					self.m.move(self.m.devices['V'],v,udist['V'])
-					for h in spaces['H']:
-						self.m.move(self.m.devices['H'],h,udist['H'])
-						data=defaultdict(list)
-						for _ in range(self.twodscan_parameters.parameters[9]):
-							while True:
-								try:
-									if self.event_stop.is_set():
-										raise Exception('Killing scan...')
-									osc.take_data()
-									for c in channels:
-										res,clipped=osc.read_waveform(channel=c)
-										data[c].append(np.array(res))
-								except IndexError:
-									continue
-								break
-						for c in channels:
-							data[c]=np.mean(data[c],axis=0)
-							if c==1: #plot channel 1
-								amplitude=self.get_amplitude(data[c])
-								img_data[spaces['V'].index(v),spaces['H'].index(h)]=amplitude
-								self.plot(img_data,l)
-								
-							final_data_form[0,:1000,channels.index(c)]=data[c]
-							final_data_form[0,1000:,channels.index(c)]=[h,v,l]
-						if counter==0:
-							final_data=np.copy(final_data_form)
-						else:
-							final_data=np.vstack((final_data_form,final_data))
-						counter+=1
-						if counter>0 and counter%1000==0: #save every 1000 waveforms
-							np.save(os.path.join(data_dir,lsi.prefix+'_1000points_position_last_3_'+str(data_file)+'.npy'),final_data)
-							del final_data
-							data_file+=1
-							counter=0
-					if h_return is not None:
-						for h_r in h_return: # return slowly to beginning position
-							self.m.move(self.m.devices['H'],int(h_r),udist['H'])
-							time.sleep(0.1)
-				if v_return is not None:
-					for v_r in v_return: # return slowly to beginning position
-						self.m.move(self.m.devices['V'],int(v_r),udist['V'])
-						time.sleep(0.1)
-			if counter>0:
-				np.save(os.path.join(data_dir,lsi.prefix+'_1000points_position_last_3_'+str(data_file)+'.npy'),final_data)
-				counter=0
-				del final_data
+			samples=osc.get_timebase().points if hasattr(osc,'get_timebase') else 1000
+			file_name=os.path.join(data_dir,lsi.prefix+'_scan_loop_'+str(current_loop)+'.npy')
+			final_data=open_scan_file(file_name,spaces,samples,len(channels),self.output_dtype)
+			scan=RasterScan(self.m,osc,channels,self.twodscan_parameters.parameters[9],self.event_stop,
+				pipelined=self.pipelined,on_pixel=self.plot,serpentine=self.serpentine,backlash=self.backlash)
+			if self.adaptive:
+				maps=scan.run_adaptive(spaces,final_data,udist,coarse=self.adaptive_coarse,threshold=self.adaptive_threshold)
+				np.save(file_name[:-len('.npy')]+'_map.npy',maps) #interpolated (L,V,H) amplitude maps
+			else:
+				scan.run(spaces,h_return,v_return,final_data,udist)
+			del final_data
 			lsi.function_executed_at_scan_end(osc)
+			
+	def start_calibration(self):
+		self.button_plot.setEnabled(False)
+		self.button_backlash.setEnabled(False)
+		worker=Worker(self.run_calibration)
+		worker.signals.finished.connect(self.thread_complete)
+		self.threadpool.start(worker)
+		
+	# Backlash of H and V from a line through the scan area in both directions, done once
+	# and kept in the cache. The line should cross a pixel edge.
+	def run_calibration(self,progress_callback):
+		self.event_stop.clear()
+		spaces,h_return,v_return=self.get_scanning_space()
+		if not spaces:
+			raise Exception('Calibration cancelled')
+		udist={}
+		for k in spaces.keys():
+			udist[k]=self.m.cached_position(self.m.devices[k])[1]
+		for axis in ['H','V']:
+			if len(spaces[axis])<5:
+				print(Fore.GREEN+'Too few points to calibrate ',axis,Style.RESET_ALL)
+				continue
+			self.backlash.calibrate(self.m,osc,axis,spaces[axis],udist,
+				channel=self.twodscan_parameters.channels[0],averages=self.twodscan_parameters.parameters[9],
+				event_stop=self.event_stop)
+		self.backlash.save()
+		
 	def get_scanning_space(self):
 		max_difference=3000
 		spaces={}
@@ -251,7 +298,7 @@ class TwoDScan(QWidget):
 			if len(v)<=0:
 				print(Fore.GREEN+'Something wrong with limit of ',k,Style.RESET_ALL)
 				return None,None,None
-			if np.all(np.abs(np.array(v)-self.m.get_position(self.m.devices[k])[0])>max_difference):
+			if np.all(np.abs(np.array(v)-self.m.cached_position(self.m.devices[k])[0])>max_difference):
 				print(Fore.GREEN+'Too big of a jump in ',k,Style.RESET_ALL)
 				return None,None,None
 		
@@ -362,6 +409,9 @@ class _Motion_Stage_Row(QWidget):
 
 	def change_motion_position(self):
 		self.motion_position.setText(str(self.value_assign.t))
+		
+	def show_position(self,position):
+		self.motion_position.setText(str(position))
 
 	def thread_complete(self):
 		print('Thread complete')
@@ -412,9 +462,13 @@ class MainWindow(QMainWindow):
 		button1.setFixedHeight(70)
 		self.widgets_to_add.append(button1)
 
-		self.threadpool = QThreadPool()
-		constant_worker=Worker(self.monitor_positions_constantly)
-		self.threadpool.start(constant_worker)
+		# Rows follow the position cache of the controller, updated by moves and a 1 s poll
+		self.position_signals=PositionSignals()
+		self.position_signals.position_changed.connect(self.show_position)
+		self.m.add_position_listener(self.emit_position)
+		for row in self.monitor_rows:
+			row.show_position(self.m.cached_position(row.stage_id)[0])
+		self.m.start_position_service(interval=1.0)
 		
 		self.set_layout()
 		
@@ -433,12 +487,14 @@ class MainWindow(QMainWindow):
 		self.setGeometry(50,50,1000,500)
 		self.setWindowTitle("Laser Driver")
 
-	def monitor_positions_constantly(self,progress_callback):
-		while True:
-			for row in self.monitor_rows:
-				time.sleep(0.05)
-				pos,upos=self.m.get_position(row.stage_id)
-				row.motion_position.setText(str(pos))
+	def emit_position(self,device_id,position,uposition): #any thread
+		self.position_signals.position_changed.emit(device_id,position)
+		
+	def show_position(self,device_id,position): #GUI thread
+		for row in self.monitor_rows:
+			if row.stage_id==device_id:
+				row.show_position(position)
+				
 	def stopall(self):
 		self.m.stopall()
 		self.twodscan.stop()
@@ -1,17 +1,41 @@
 import pyvisa as visa
 import numpy as np
 import time
+from collections import namedtuple
+from simulated_instruments import simulation_enabled, SimulatedKeithleySession
+from scpi_trace import traced
+
+# Elements returned per reading with the default :FORM:ELEM (VOLT,CURR,RES,TIME,STAT)
+reading_dtype=np.dtype([('voltage','f8'),('current','f8'),('resistance','f8'),('timestamp','f8'),('status','f8')])
+
+# Single reading of the SMU, timestamp and status as reported by the instrument
+Reading=namedtuple('Reading',['voltage','current','timestamp','status'])
+
+# Status word bit set while the source is in real compliance
+compliance_bit=0x8
+
+def reading_in_compliance(reading):
+	return bool(int(reading.status) & compliance_bit)
 
 class keithley_2410():
 
-	def __init__(self, address=23, gpib_num=1):
-		rm=visa.ResourceManager()
+	def __init__(self, address=23, gpib_num=1, simulate=None, trace=None):
 		self.data_dict={}
-		self.device=rm.open_resource("GPIB"+str(gpib_num)+"::"+str(address)+"::INSTR")
+		if simulation_enabled(simulate):
+			self.device=SimulatedKeithleySession()
+		else:
+			rm=visa.ResourceManager()
+			self.device=rm.open_resource("GPIB"+str(gpib_num)+"::"+str(address)+"::INSTR")
+		self.device=traced(self.device,'keithley',trace)	# Opt-in, see scpi_trace
 		print(self.device.query('*IDN?'))
 		#self.device.write('OUTPut1:STAT OFF')
+		self.reading_max_age=None	# Default cache age in s for measure(), None always reads
+		self.clear_reading()
 
-	def in_compliance(self):
+	# With max_age the status of a cached reading is used instead of a new query
+	def in_compliance(self,max_age=None):
+		if max_age is not None:
+			return reading_in_compliance(self.measure(max_age))
 		return bool(float(self.device.query('SENS:CURR:PROT:TRIP?')))
 
 	def initialize_IV(self, compliance_in_amps=0.000005):
@@ -38,24 +62,82 @@ class keithley_2410():
 
 	def turn_on(self):
 		self.device.write('OUTPut1:STAT ON')
+		self.clear_reading()
 
 	def set_voltage(self,volts,special=False):
 		if volts>0 and not special:
 			volts*=-1
 			print('volts are +, making them -')
 		self.device.write('SOUR:VOLT:LEV:IMM:AMPL '+str(volts))
+		self.clear_reading()
+	
+	# Delay between sourcing and measuring, so every reading is taken after the step settled
+	def set_source_delay(self,seconds=None):
+		if seconds is None:
+			self.device.write(':SOUR:DEL:AUTO ON')
+		else:
+			self.device.write(':SOUR:DEL:AUTO OFF')
+			self.device.write(':SOUR:DEL '+str(seconds))
 	
 	def get_data(self):
+		return self.device.query(':READ?')	# INIT and FETC? in one round trip
+		
+	# One reading with voltage and current together. A reading younger than max_age
+	# seconds is reused, so ramps and metadata writers do not re-trigger the SMU
+	def measure(self,max_age=None):
+		if max_age is None:
+			max_age=self.reading_max_age
+		if max_age is not None and self.last_reading is not None \
+				and time.time()-self.last_reading_time<=max_age:
+			return self.last_reading
+		data=self.get_data().split(',')
+		self.last_reading=Reading(float(data[0]),float(data[1]),float(data[3]),int(float(data[4])))
+		self.last_reading_time=time.time()
+		return self.last_reading
+		
+	def clear_reading(self):
+		self.last_reading=None
+		self.last_reading_time=0
+		
+	def get_current(self,max_age=None):
+		return self.measure(max_age).current
+		
+	def get_voltage(self,max_age=None):
+		return self.measure(max_age).voltage
+
+	# Buffered sampling with the trigger model: the arm layer timer paces count readings
+	# into the trace buffer on the instrument. Returns immediately so that other
+	# instruments can be read while the SMU samples, collect with fetch_buffered.
+	def start_buffered(self,count=20,interval=0.1):
+		if not 1<=count<=2500:
+			raise Exception('Buffered sampling supports 1 to 2500 readings')
+		self.device.write(':TRAC:CLE')
+		self.device.write(':TRAC:POIN '+str(int(count)))
+		self.device.write(':TRAC:FEED SENS')
+		self.device.write(':TRAC:FEED:CONT NEXT')
+		self.device.write(':ARM:SOUR TIM')
+		self.device.write(':ARM:TIM '+str(interval))
+		self.device.write(':ARM:COUN '+str(int(count)))
+		self.device.write(':TRIG:COUN 1')
 		self.device.write(':INIT')
-		return self.device.query('FETC?')
+		self.buffered_done=time.time()+count*interval
 		
-	def get_current(self):
-		data=self.get_data()
-		return float(data.split(',')[1])
+	# Waits for the buffer to fill and reads it in a single transfer as a reading_dtype array
+	def fetch_buffered(self):
+		remaining=self.buffered_done-time.time()
+		if remaining>0:
+			time.sleep(remaining)
+		self.device.query('*OPC?')
+		data=self.device.query(':TRAC:DATA?')
+		self.device.write(':TRAC:FEED:CONT NEV')
+		self.device.write(':ARM:SOUR IMM')
+		self.device.write(':ARM:COUN 1')
+		values=np.array(data.split(','),dtype=np.float64).reshape(-1,len(reading_dtype.names))
+		return values.view(reading_dtype)[:,0]
 		
-	def get_voltage(self):
-		data=self.get_data()
-		return float(data.split(',')[0])	
+	def acquire_buffered(self,count=20,interval=0.1):
+		self.start_buffered(count,interval)
+		return self.fetch_buffered()
 		
 	def do_IV_Investigator(self,start=-6,end=-20,steps=30,samples=10,other_keithley=None,step_sleep=1,rounded=1):
 		voltages=np.linspace(start,end,steps)
@@ -1,17 +1,111 @@
 import os
+import time
+from collections import namedtuple
 import pyvisa as visa
+from simulated_instruments import simulation_enabled, SimulatedQDLaserSession
+from scpi_trace import traced
+
+control_registers = ['TMP', 'AT3', 'VGG', 'BIA', 'CKS', 'TEC', 'LDD']
+monitor_registers = ['TEM', 'VGM', 'BIM', 'V3M', 'V5M', 'ALM']
+
+# Registers whose readback may be stale after a write to the given register
+write_affects = {'VGG': ['VGG', 'VGM'],
+                 'BIA': ['BIA', 'BIM'],
+                 'TMP': ['TMP', 'TEM', 'ALM'],
+                 'AT3': ['AT3', 'ALM'],
+                 'CKS': ['CKS'],
+                 'TEC': ['TEC', 'TEM', 'ALM'],
+                 'LDD': ['LDD', 'BIM', 'VGM']}
+
+trigger_names = ['Ext CLK1', 'Ext CLK2', 'Internal OSC', 'Stop']
+
+# Settings in degC, mV, mA and V, alarms and on/off states as bools
+LaserSnapshot = namedtuple('LaserSnapshot', ['timestamp',
+    'temp_setting', 'temp_alarm_setting', 'gate_setting', 'bias_setting',
+    'trigger', 'tec_on', 'current_on',
+    'ld_temp', 'ld_temp_alarm', 'gate_voltage', 'bias_current',
+    'supply_3v', 'supply_3v_alarm', 'supply_5v', 'supply_5v_alarm'])
 
 class QD_Laser():
-    def __init__(self):
-        rm=visa.ResourceManager()
+    def __init__(self, simulate=None, trace=None):
         self.data_dict={}
-        self.device=rm.open_resource("ASRL7::INSTR")
+        if simulation_enabled(simulate):
+            self.device=SimulatedQDLaserSession()
+        else:
+            rm=visa.ResourceManager()
+            self.device=rm.open_resource("ASRL7::INSTR")
+        self.device=traced(self.device, 'qd_laser', trace)     # Opt-in, see scpi_trace
+        self.suspect=set(control_registers+monitor_registers)  # Not yet known to be up to date
+        self.written={}                                         # Register -> value of the last write
+        self.settle_reads=5     # Reads before an unchanged register counts as stable, see settled
+
+    # Writes a REG=value command and marks the registers it affects as suspect
+    def write_register(self, command):
+        register, _, value = command.partition('=')
+        self.suspect.update(write_affects.get(register, [register]))
+        self.written[register] = value
+        self.device.write(command)
+
+    # Replies of a suspect register so far, oldest first. A written register is up to date once
+    # it reads back the written value, stale replies can repeat so two equal reads are not enough.
+    # Registers changed indirectly (monitors, alarms) need two equal reads after the reply changed,
+    # or after settle_reads reads if the write did not change them.
+    def settled(self, register, replies):
+        if register in self.written:
+            return replies[-1].strip().startswith(self.written[register])
+        if len(replies) < 2 or replies[-1] != replies[-2]:
+            return False
+        return replies[-1] != replies[0] or len(replies) >= self.settle_reads
+
+    def mark_settled(self, register):
+        self.suspect.discard(register)
+        self.written.pop(register, None)
 
     # The laser tends to give not up-to-date values shortly after changes, hence a loop was implemented
-    def query_loop(self, task):
-        for i in range(0,10):
-            query = self.device.query(str(task)+'?')
-        return query
+    # Suspect registers are read until settled, at most max_reads times, others are read once
+    def query_loop(self, task, max_reads=10):
+        replies = [self.device.query(str(task)+'?')]
+        if task in self.suspect:
+            while not self.settled(task, replies) and len(replies) < max_reads:
+                replies.append(self.device.query(str(task)+'?'))
+            if self.settled(task, replies):
+                self.mark_settled(task)
+        return replies[-1]
+
+    # Reads all control and monitor registers in one pass and repeats only the suspect
+    # ones until they are settled, at most max_reads times each
+    def snapshot(self, max_reads=10):
+        replies = {}
+        for register in control_registers+monitor_registers:
+            replies[register] = [self.device.query(register+'?')]
+        unstable = [r for r in replies if r in self.suspect and not self.settled(r, replies[r])]
+        for i in range(1,max_reads):
+            if not unstable:
+                break
+            for r in unstable:
+                replies[r].append(self.device.query(r+'?'))
+            unstable = [r for r in unstable if not self.settled(r, replies[r])]
+        for r in replies:
+            if r in self.suspect and r not in unstable:
+                self.mark_settled(r)
+        values = {r: replies[r][-1] for r in replies}
+        alarm = values['ALM'][:3]
+        return LaserSnapshot(timestamp = time.time(),
+            temp_setting = int(values['TMP'][:4])/100,
+            temp_alarm_setting = int(values['AT3'][:4])/100,
+            gate_setting = int(values['VGG'][:4]),
+            bias_setting = int(values['BIA'][:4])/10,
+            trigger = trigger_names[int(values['CKS'][0])],
+            tec_on = bool(int(values['TEC'])),
+            current_on = bool(int(values['LDD'][0])),
+            ld_temp = int(values['TEM'][:4])/100,
+            ld_temp_alarm = bool(int(alarm[0])),
+            gate_voltage = -int(values['VGM'][1:5]),
+            bias_current = int(values['BIM'][:4])/10,
+            supply_3v = int(values['V3M'][:4])/1000,
+            supply_3v_alarm = bool(int(alarm[1])),
+            supply_5v = int(values['V5M'][:4])/1000,
+            supply_5v_alarm = bool(int(alarm[2])))
 
     def set_gate(self, value=None):
         if not value:
@@ -19,11 +113,10 @@ class QD_Laser():
         elif not (value>=200 and value<=2050):
             print('Gate value out of range [200, 2050] mV')
         else:
-            self.device.write('VGG='+str(int(value)).zfill(4))
+            self.write_register('VGG='+str(int(value)).zfill(4))
         
     def get_gate(self):
-        self.query_loop('VGG')
-        return self.device.query('VGG?')[:4]
+        return self.query_loop('VGG')[:4]
     
     def set_bias(self, value=None):
         if not value:
@@ -31,11 +124,10 @@ class QD_Laser():
         elif not (value>=0 and value<=100):
             print('Bias current value out of range [0.0, 100.0] mA')
         else:
-            self.device.write('BIA='+str(int(value*10)).zfill(4))
+            self.write_register('BIA='+str(int(value*10)).zfill(4))
         
     def get_bias(self):
-        self.query_loop('BIA')
-        return self.device.query('BIA?')[:4]
+        return self.query_loop('BIA')[:4]
 
     def set_temp(self, value=None):
         if not value:
@@ -43,11 +135,10 @@ class QD_Laser():
         elif not (value>=10 and value<=45):
             print(u'Temperature value out of range [10.00, 45.00]\N{DEGREE SIGN}C')
         else:
-            self.device.write('TMP='+str(int(value*100)).zfill(4))
+            self.write_register('TMP='+str(int(value*100)).zfill(4))
         
     def get_temp(self):
-        self.query_loop('TMP')
-        return self.device.query('TMP?')[:4]
+        return self.query_loop('TMP')[:4]
 
     def set_temp_alarm(self, value=None):
         if not value:
@@ -55,17 +146,16 @@ class QD_Laser():
         elif not (value>=35 and value<=45):
             print(u'Temperature alarm value out of range [35.00, 45.00]\N{DEGREE SIGN}C')
         else:
-            self.device.write('AT3='+str(int(value*100)).zfill(4))
+            self.write_register('AT3='+str(int(value*100)).zfill(4))
         
     def get_temp_alarm(self):
-        self.query_loop('AT3')
-        return self.device.query('AT3?')[:4]
+        return self.query_loop('AT3')[:4]
 
     def trigger_on(self):
-        self.device.write('CKS=2')
+        self.write_register('CKS=2')
         
     def trigger_off(self):
-        self.device.write('CKS=3')
+        self.write_register('CKS=3')
     
     def trigger_external(self, source=None):  
         if not (source==1 or source==2):
@@ -76,29 +166,27 @@ class QD_Laser():
                 print('Invalid external source, for CLK1 provide source=1, for CLK2 provide source=2')
         else:
             source=int(source)-1
-        self.device.write('CKS='+str(source))
+        self.write_register('CKS='+str(source))
 
     def trigger_status(self):
-        self.query_loop('CKS')
-        trig_name = ['Ext CLK1', 'Ext CLK2', 'Internal OSC', 'Stop']
-        trig_val = self.device.query('CKS?')[0]
-        return trig_name[int(trig_val)]
+        trig_val = self.query_loop('CKS')[0]
+        return trigger_names[int(trig_val)]
 
     def tec_off(self):
-        self.device.write('TEC=0')
+        self.write_register('TEC=0')
         
     def tec_on(self):
-        self.device.write('TEC=1')
+        self.write_register('TEC=1')
         
     def tec_status(self):
         # return int(self.query_loop('TEC')[0])
         return int(self.query_loop('TEC'))
         
     def current_off(self):
-        self.device.write('LDD=0')
+        self.write_register('LDD=0')
         
     def current_on(self):
-        self.device.write('LDD=1')
+        self.write_register('LDD=1')
         
     def current_status(self):
         return int(self.query_loop('LDD')[0])
@@ -121,38 +209,43 @@ class QD_Laser():
     def monitor_alarm(self):
         return self.query_loop('ALM')[:3]
     
-    def control_report(self):
+    def control_report(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
         status_name = ['OFF', 'ON']
         report = []
-        report.append(u'Temp setting   '+str(int(self.get_temp())/100)+'\N{DEGREE SIGN}C')
-        report.append(u'Temp alarm     '+str(int(self.get_temp_alarm())/100)+'\N{DEGREE SIGN}C')
-        report.append('Gate setting   '+str(int(self.get_gate()))+' mV')
-        report.append('Bias setting   '+str(int(self.get_bias())/10)+' mA')
-        report.append('Trigger set    '+str(self.trigger_status()))
-        report.append('TEC  status:   '+status_name[int(self.tec_status())])
-        report.append('Bias status:   '+status_name[int(self.current_status())])
+        report.append(u'Temp setting   '+str(snapshot.temp_setting)+'\N{DEGREE SIGN}C')
+        report.append(u'Temp alarm     '+str(snapshot.temp_alarm_setting)+'\N{DEGREE SIGN}C')
+        report.append('Gate setting   '+str(snapshot.gate_setting)+' mV')
+        report.append('Bias setting   '+str(snapshot.bias_setting)+' mA')
+        report.append('Trigger set    '+str(snapshot.trigger))
+        report.append('TEC  status:   '+status_name[int(snapshot.tec_on)])
+        report.append('Bias status:   '+status_name[int(snapshot.current_on)])
         return report
     
-    def monitor_report(self):
+    def monitor_report(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
         alarm_status = ['OK', 'ALARM']
         report = []
-        report.append(u'LD temperature '+str(int(self.monitor_temp())/100)+'\N{DEGREE SIGN}C')
-        report.append('LD temp alarm  '+alarm_status[int(self.monitor_alarm()[0])])
-        report.append('Gate voltage  -'+str(int(self.monitor_gate()))+' mV')
-        report.append('Bias current   '+str(int(self.monitor_bias())/10)+' mA')
-        report.append('+3.3V supply   '+str(int(self.monitor_3vsup())/1000)+' V')
-        report.append('+3.3V alarm    '+alarm_status[int(self.monitor_alarm()[1])])
-        report.append('+5V supply     '+str(int(self.monitor_5vsup())/1000)+' V')
-        report.append('+5V alarm      '+alarm_status[int(self.monitor_alarm()[2])])
+        report.append(u'LD temperature '+str(snapshot.ld_temp)+'\N{DEGREE SIGN}C')
+        report.append('LD temp alarm  '+alarm_status[int(snapshot.ld_temp_alarm)])
+        report.append('Gate voltage  '+str(snapshot.gate_voltage)+' mV')
+        report.append('Bias current   '+str(snapshot.bias_current)+' mA')
+        report.append('+3.3V supply   '+str(snapshot.supply_3v)+' V')
+        report.append('+3.3V alarm    '+alarm_status[int(snapshot.supply_3v_alarm)])
+        report.append('+5V supply     '+str(snapshot.supply_5v)+' V')
+        report.append('+5V alarm      '+alarm_status[int(snapshot.supply_5v_alarm)])
         return report
 
     def show_report(self):
+        snapshot = self.snapshot()
         print('\nControl report')
-        c_report = self.control_report()
+        c_report = self.control_report(snapshot)
         for line in c_report:
             print(line)
         print('\nMonitor report')
-        m_report = self.monitor_report()
+        m_report = self.monitor_report(snapshot)
         for line in m_report:
             print(line)
 
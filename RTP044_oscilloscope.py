@@ -4,16 +4,119 @@ import pyvisa as visa
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+from contextlib import contextmanager
+
+from scope_timebase import Timebase
+from simulated_instruments import simulation_enabled, SimulatedRTP044Session
+from scpi_trace import traced
+
+### Binary waveform formats and the matching little endian NumPy types
+binary_formats = {'REAL,32': '<f4', 'INT,8': 'i1', 'INT,16': '<i2'}
+### ADC levels covering the full vertical range (10 divisions) for integer formats
+int_levels = {'INT,8': 253, 'INT,16': 65024}
+### Measurement result fields (SCPI node) and the matching structured array field
+meas_fields = {'AVG': ('avg', 'f8'), 'STDDev': ('stddev', 'f8'), 'EVTCount': ('evtcount', 'i8'),
+               'ACTual': ('actual', 'f8'), 'NPEak': ('npeak', 'f8'), 'PPEak': ('ppeak', 'f8'),
+               'RMS': ('rms', 'f8'), 'WFMCount': ('wfmcount', 'i8')}
+
+### Queues writes while a batch is open, see rhodeschwarz_rtp044.batch
+### Queued commands go out as one ';'-chained message, each followed by SYST:ERR:COUNt? so
+### a single reply tells which command, if any, put an error into the queue. The message starts
+### with one more count, errors left from before the batch do not fail it. A query sent
+### during the batch is appended to the same message. Block transfers and OPC-synchronised
+### writes send the queue first and then run unchanged on the session.
+class BatchedSession():
+
+    def __init__(self, session):
+        object.__setattr__(self, 'session', session)
+        object.__setattr__(self, 'queue', [])
+
+    def write(self, command):
+        command = command.strip()
+        if not command.startswith((':', '*')):
+            command = ':'+command               # Chained headers must start from the root
+        self.queue.append(command)
+
+    write_str = write
+
+    def query(self, command=None):
+        commands = list(self.queue)
+        del self.queue[:]
+        message = ':SYSTem:ERRor:COUNt?;'        # Errors already queued before the batch
+        message += ''.join(c+';:SYSTem:ERRor:COUNt?;' for c in commands)
+        if command is None:
+            message += '*OPC?'
+        else:
+            message += command.strip()+';:SYSTem:ERRor:COUNt?'
+        replies = self.session.query(message).strip().split(';')
+        queued = len(commands)
+        counts = [int(c) for c in replies[:queued+1]]
+        if command is not None:
+            counts.append(int(replies[-1]))
+            commands.append(command.strip())
+        for i in range(len(commands)):
+            if counts[i+1] > counts[i]:         # The count is cumulative, only an increase is new
+                errors = self.session.query(':SYSTem:ERRor:ALL?').strip()
+                raise Exception('Instrument error {} caused by {}'.format(errors, commands[i]))
+        if command is not None:
+            return ';'.join(replies[queued+1:-1])
+
+    query_str = query
+
+    def flush(self):
+        if self.queue:
+            self.query()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.session, name)
+        if callable(attribute):
+            self.flush()                        # Keeps the order of queued writes
+        return attribute
+
+    def __setattr__(self, name, value):
+        setattr(self.session, name, value)
 
 class rhodeschwarz_rtp044():
    
-    def __init__(self,default_channel=1):
-        self.device = RsInstrument('GPIB1::20::INSTR', True, False)
+    def __init__(self,default_channel=1,simulate=None,trace=None):
+        if simulation_enabled(simulate):
+            self.device = SimulatedRTP044Session()
+        else:
+            self.device = RsInstrument('GPIB1::20::INSTR', True, False)
+        self.device = traced(self.device, 'rtp044', trace)   # Opt-in, see scpi_trace
         print(self.device.query('*IDN?'))
         self.default_channel=default_channel
         self.visa_timeout = 6000                # Timeout for VISA Read Operations
         self.opc_timeout = 3000                 # Timeout for opc-synchronised operations
-        self.instrument_status_checking = True  # Error check after each command
+        self.instrument_status_checking = True  # Error check after each command, suspended in batch()
+        self.device.instrument_status_checking = self.instrument_status_checking
+        self.data_format = 'REAL,32'            # Waveform transfer format, see set_data_format
+        self.format_sent = None                 # Last format written to the instrument
+        self.device.write('FORM:BORD LSBF')     # Binary blocks little endian
+        self.timebase = None                    # Cached Timebase, see get_timebase
+        self.stats_enabled = set()              # Measurement groups with statistics enabled
+        self.history_channels = set()           # Channels in history mode, see read_segments
+        self.vertical_cache = {}                # Channel -> (range, offset) for INT formats, see get_int_conversion
+
+    # Writes inside the block are queued and sent as one command, with one error check
+    # when the block ends or a query needs the instrument. Nested batches join the outer one.
+    @contextmanager
+    def batch(self):
+        if isinstance(self.device, BatchedSession):
+            yield self
+            return
+        session = self.device
+        session.instrument_status_checking = False
+        batched = BatchedSession(session)
+        self.device = batched
+        try:
+            yield self
+        finally:
+            try:
+                batched.flush()
+            finally:
+                self.device = session
+                session.instrument_status_checking = self.instrument_status_checking
 
     def convert_units(self,quantity,units):
         unit_symbol = units[0]
@@ -55,8 +158,10 @@ class rhodeschwarz_rtp044():
             channel=self.default_channel
         if not units == 'V':
             scale = self.convert_units(scale,units)
-        self.device.write(':CHANNEL'+str(channel)+':SCAL '+str(scale))
-        return self.device.query(':CHANNEL'+str(channel)+':SCAL?')
+        self.vertical_cache.pop(channel, None)
+        with self.batch():                      # Write and readback in one message
+            self.device.write(':CHANNEL'+str(channel)+':SCAL '+str(scale))
+            return self.device.query(':CHANNEL'+str(channel)+':SCAL?')
    
     def get_scale(self,channel=None):
         if not channel:
@@ -74,6 +179,7 @@ class rhodeschwarz_rtp044():
         current_offset=float(self.device.query(':CHANNEL'+str(channel)+':OFFSET?'))
         if not units == 'V':
             delta = self.convert_units(delta,units)
+        self.vertical_cache.pop(channel, None)
         self.device.write(':CHANNEL'+str(channel)+':OFFSET '+str(current_offset+delta))
 	
     def set_offset(self,val,units='V',channel=None):
@@ -81,6 +187,7 @@ class rhodeschwarz_rtp044():
             channel=self.default_channel
         if not units == 'V':
             val = self.convert_units(val,units)
+        self.vertical_cache.pop(channel, None)
         self.device.write(':CHANNEL'+str(channel)+':OFFSET '+str(val))
         
     def get_offset(self,channel=None):
@@ -92,6 +199,7 @@ class rhodeschwarz_rtp044():
         if not units == 's':
             value = self.convert_units(value,units)
         self.device.write_str(':TIM:SCAL '+str(value))
+        self.timebase = None
  
     def get_timescale(self):
         return float(self.device.query(':TIM:SCAL?'))
@@ -100,10 +208,20 @@ class rhodeschwarz_rtp044():
         if not units == 's':
             delay = self.convert_units(delay,units)
         self.device.write(':TIM:HOR:POS '+str(delay))
+        self.timebase = None
         
     def get_timedelay(self):
         return float(self.device.query(':TIM:HOR:POS?'))
 
+    def set_resolution(self,value,units='s'):
+        if not units == 's':
+            value = self.convert_units(value,units)
+        self.device.write(':ACQ:RES '+str(value))
+        self.timebase = None
+
+    def get_resolution(self):
+        return float(self.device.query(':ACQ:RES?'))
+
     def check_channel_state(self,channel=None):
         if not channel:
             print('No channel specified for state check')
@@ -157,22 +275,93 @@ class rhodeschwarz_rtp044():
         rs_timedelay = self.get_timedelay()
         print(f'Timescale set to {rs_timescale} s per division with offser {rs_timedelay} s') 
 
-    def read_waveform(self,channel=None):
+    # Supported formats: 'REAL,32', 'INT,8', 'INT,16' (binary) and 'ASC,0' (slow fallback)
+    def set_data_format(self,data_format='REAL,32'):
+        if data_format not in binary_formats and data_format != 'ASC,0':
+            print('Unsupported data format, please use REAL,32, INT,8, INT,16 or ASC,0')
+            return
+        self.data_format = data_format
+
+    def send_data_format(self,data_format):
+        if not data_format == self.format_sent:
+            self.device.write('FORM:DATA '+data_format)
+            self.format_sent = data_format
+
+    # Returns (gain, offset) converting INT samples to Volts. The vertical settings are read
+    # in a single round trip and cached per channel until set_scale or an offset change.
+    def get_int_conversion(self,data_format,channel=None):
         if not channel:
             channel=self.default_channel
-        self.device.write('FORM:DATA ASC,0')
-        all_data = self.device.query(':CHANnel'+str(channel)+':WAVeform:DATA?').split(',')
-        data = [float(x) for x in all_data]
+        if channel not in self.vertical_cache:
+            ch = ':CHANnel'+str(channel)
+            v_range, v_offset, v_position, v_scale = [float(x) for x in self.device.query(
+                ch+':RANGe?;'+ch+':OFFSet?;'+ch+':POSition?;'+ch+':SCALe?').split(';')]
+            self.vertical_cache[channel] = (v_range, v_offset - v_position*v_scale)
+        v_range, offset = self.vertical_cache[channel]
+        return v_range/int_levels[data_format], offset
+
+    def read_waveform(self,channel=None,data_format=None):
+        if not channel:
+            channel=self.default_channel
+        if not data_format:
+            data_format = self.data_format
+        self.send_data_format(data_format)
+        query = ':CHANnel'+str(channel)+':WAVeform:DATA?'
+        if data_format == 'ASC,0':
+            return np.array(self.device.query(query).split(','), dtype=np.float64)
+        raw = np.frombuffer(self.device.query_bin_block(query), dtype=binary_formats[data_format])
+        if data_format == 'REAL,32':
+            return raw.astype(np.float64)
+        gain, offset = self.get_int_conversion(data_format, channel)
+        return raw*gain + offset
+
+    ## Multi-acquisition (fast segmentation) readout
+    ## Arms the scope for exactly count triggers and waits until all are in the history
+    def arm_segments(self,count):
+        with self.batch():
+            self.device.write(':ACQuire:SEGMented:STATe ON')
+            self.device.write(':ACQuire:COUNt '+str(int(count)))
+        self.device.write_str_with_opc(':RUNSingle')
+        self.segment_count = int(count)
+
+    ## Reads all segments of the last armed acquisition as one (count, samples) array
+    def read_segments(self,channel=None,data_format=None):
+        if not channel:
+            channel=self.default_channel
+        with self.batch():                      # Settings go out just before the block read
+            self.device.write(':EXPort:WAVeform:FASTexport ON')
+            self.device.write(':CHANnel'+str(channel)+':HISTory:STATe ON')
+            self.history_channels.add(channel)
+            data = self.read_waveform(channel=channel,data_format=data_format)
+        return data.reshape(self.segment_count,-1)
+
+    ## Returns the scope to single acquisitions, history is discarded on next trigger
+    def end_segments(self):
+        with self.batch():
+            for channel in sorted(self.history_channels):
+                self.device.write(':CHANnel'+str(channel)+':HISTory:STATe OFF')
+            self.history_channels.clear()
+            self.device.write(':EXPort:WAVeform:FASTexport OFF')
+            self.device.write(':ACQuire:SEGMented:STATe OFF')
+            self.device.write(':ACQuire:COUNt 1')
+
+    ## N distinct triggers of one channel in one bulk transfer, shape (count, samples)
+    def acquire_segments(self,count,channel=None,data_format=None):
+        self.arm_segments(count)
+        data = self.read_segments(channel=channel,data_format=data_format)
+        self.end_segments()
         return data
 
+    ## Header is xstart,xstop,record length,values per sample - one query per settings change
+    def get_timebase(self):
+        if self.timebase is None:
+            header = self.device.query(':CHANnel'+str(self.default_channel)+':DATA:HEADer?').split(',')
+            x_start, x_stop, points = float(header[0]), float(header[1]), int(header[2])
+            self.timebase = Timebase(points, (x_stop-x_start)/points, x_start)
+        return self.timebase
+
     def read_timebase(self):
-        time_range = float(self.device.query(':TIM:RANGe?'))
-        time_delay = self.get_timedelay()
-        base_start = -time_range/2 + time_delay
-        base_end = +time_range/2 + time_delay
-        base_res = float(self.device.query(':ACQ:RES?'))
-        base = list(np.arange(base_start,base_end,base_res))
-        return base
+        return self.get_timebase().axis
 
     def plot_waveform(self,channel=None):
         if not channel:
@@ -225,37 +414,58 @@ class rhodeschwarz_rtp044():
     def clear_meas(self,group=1):
         self.device.write(":MEASurement"+str(group)+":CLEar")
 
+    # All groups cleared with a single chained command
+    def clear_meas_groups(self,groups=(1,2,3,4,5)):
+        self.device.write(";".join(":MEASurement"+str(group)+":CLEar" for group in groups))
+
+    # Statistics are enabled once per group, not before every result query
+    def enable_statistics(self,groups=(1,2,3,4,5)):
+        groups = [group for group in groups if group not in self.stats_enabled]
+        if groups:
+            self.device.write(";".join(":MEASurement"+str(group)+":STATistics:ENABle 1" for group in groups))
+            self.stats_enabled.update(groups)
+
+    # Reads all requested result fields of all groups in one chained query
+    # Returns a structured array with one row per group, fields named as in meas_fields
+    def fetch_statistics(self,groups=(1,2,3,4,5),fields=('AVG','STDDev','EVTCount')):
+        self.enable_statistics(groups)
+        query = ";".join(":MEASurement"+str(group)+":RESult:"+field+"?" for group in groups for field in fields)
+        values = self.device.query(query).strip().split(';')
+        if len(values) != len(groups)*len(fields):
+            raise Exception('Expected {} statistics values, got {}'.format(len(groups)*len(fields), len(values)))
+        result = np.zeros(len(groups), dtype=[('group', 'i4')]+[meas_fields[field] for field in fields])
+        result['group'] = groups
+        for i, field in enumerate(fields):
+            result[meas_fields[field][0]] = [float(v) for v in values[i::len(fields)]]
+        return result
+
     def run_meas(self,group=1,count=1000):
-        self.device.write(":MEASurement"+str(group)+":CLEar")
-        self.device.write(":MEASurement"+str(group)+":LTMeas:COUNt "+str(count))
-        self.device.write(":MEASurement"+str(group)+":LTMeas:STATe ON")
+        with self.batch():
+            self.device.write(":MEASurement"+str(group)+":CLEar")
+            self.device.write(":MEASurement"+str(group)+":LTMeas:COUNt "+str(count))
+            self.device.write(":MEASurement"+str(group)+":LTMeas:STATe ON")
 
 # Need to check that the group meas is enabled, becuase otherwise it fails/freezes
     def get_meas(self,group=1):
-        self.device.write(":MEASurement"+str(group)+":STATistics:ENABle 1")
+        self.enable_statistics([group])
         meas = self.device.query(":MEASurement"+str(group)+":RESult:AVG?")
         return meas
 
     def get_meas_std(self,group=1):
-        self.device.write(":MEASurement"+str(group)+":STATistics:ENABle 1")
+        self.enable_statistics([group])
         meas_std = self.device.query(":MEASurement"+str(group)+":RESult:STDDev?")
         return meas_std
 
     def get_meas_count(self,group=1):
-        self.device.write(":MEASurement"+str(group)+":STATistics:ENABle 1")
+        self.enable_statistics([group])
         meas_count = self.device.query(":MEASurement"+str(group)+":RESult:EVTCount?")
         return meas_count
 
 ### ---------------------------------------------------------------------------
 
 def quick_acquire(samples=10):
-    rs.run()
-    data = np.array(rs.read_timebase())[:-1]
-    for i in range(0,samples):
-        values = rs.read_waveform(channel=2)
-        values = np.array(values)
-        data = np.vstack([data, values])
-        #rs.single()
+    data = rs.read_timebase()
+    data = np.vstack([data, rs.acquire_segments(samples, channel=2)])
     #data = np.transpose(data)
     #np.savetxt('LGAD_array_240V_gate830mv_bias90mA_20C.csv', data, delimiter=',', fmt='%.7g')
     return data
@@ -1,14 +1,17 @@
 import serial
 import time
+from simulated_instruments import simulation_enabled, SimulatedSerial
+from scpi_trace import traced
 
 class TTI_QL355TP():
 
-	def __init__(self, main_channel=1):
+	def __init__(self, main_channel=1, simulate=None, trace=None):
 	
 		self.data_dict={}
 		self.main_channel=main_channel
 		
-		ser = serial.Serial(port='COM8',
+		serial_class = SimulatedSerial if simulation_enabled(simulate) else serial.Serial
+		ser = serial_class(port='COM8',
 			baudrate=9600,
 			parity=serial.PARITY_NONE,
 			stopbits=serial.STOPBITS_ONE,
@@ -16,7 +19,7 @@ class TTI_QL355TP():
 		)
 		if not ser.isOpen():
 			ser.open()
-		self.device=ser
+		self.device=traced(ser,'tti',trace)	# Opt-in, see scpi_trace
 		print(self.write_ser('*IDN?'))
 
 	#self.write_ser('OVP1 6')
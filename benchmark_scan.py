@@ -0,0 +1,219 @@
+import time,os,json,argparse,tempfile,subprocess
+
+### Scan throughput benchmark on the simulated instruments
+### Runs the voltage scan point loop (scan_voltage_point, as execute_TCT_scan_voltage.py does)
+### and the TwoDScan raster (RasterScan) against the latency models of simulated_instruments,
+### then reports points per hour and the time spent in every stage. Results are saved as JSON,
+### pass --compare with an earlier result to see the change per stage.
+###
+### python benchmark_scan.py --label lab --output bench_lab.json
+### python benchmark_scan.py --latency slow_gpib.json --compare bench_lab.json
+###
+### --trace adds the instrument command histograms (scpi_trace) to the results.
+###
+### The latency file overrides simulated_instruments.latency_models, e.g.
+### {"rtp044": {"per_command": 0.01, "per_byte": 2e-6, "overrides": {"CHAN#:DATA?": 0.05}}}
+
+os.environ['TCT_SIMULATE'] = '1'    # Before any driver is imported
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import simulated_instruments
+from simulated_instruments import LatencyModel, latency_models
+
+def load_latency_models(file_name=None, scale=None):
+    if file_name is not None:
+        with open(file_name) as f:
+            for name, model in json.load(f).items():
+                if name not in latency_models:
+                    raise Exception('Unknown instrument {} in {}'.format(name, file_name))
+                latency_models[name] = LatencyModel(**model)
+    if scale is not None:
+        os.environ['TCT_SIM_LATENCY'] = str(scale)
+    return {name: {'per_command': m.per_command, 'per_byte': m.per_byte, 'overrides': m.overrides}
+            for name, m in latency_models.items()}
+
+def source_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+### Voltage scan, same calls per point as execute_TCT_scan_voltage.py
+### dwell_scale shortens the fixed waits (settle, current sampling) which do not depend on the code
+def benchmark_voltage_scan(work_dir, points=20, step=-5, dwell_scale=1.0, wf_samples=10,
+        save_waveforms=True):
+    from Keithley_control import keithley_2410
+    from RTP044_oscilloscope import rhodeschwarz_rtp044
+    from cmd_lib import ramp_voltage, AcquisitionBuffer, ScaleCache, StageTimer
+    from cmd_lib import scan_voltage_point, plot_voltage_grid, summary_columns
+    from waveform_store import WaveformStore
+
+    k   = keithley_2410(address=24, gpib_num=0)
+    osc = rhodeschwarz_rtp044()
+    k.initialize_IV(compliance_in_amps=0.000005)
+    k.switch_rear_terminal()
+    k.turn_on()
+    ramp_voltage(k, target_voltage = 0)
+
+    volt_array = np.arange(-5, -5+points*step, step)
+    scale_cache = ScaleCache(os.path.join(work_dir, 'scale_cache_bench.json'))
+    wf_buffer = AcquisitionBuffer(len(osc.read_timebase()), wf_samples)
+    wf_store = None
+    if save_waveforms:
+        wf_store = WaveformStore(os.path.join(work_dir, 'wf_bench.h5'), osc.get_timebase(), wf_samples)
+    out = np.full((len(volt_array), len(summary_columns)), np.nan)
+
+    timer = StageTimer()
+    with open(os.path.join(work_dir, 'bench_log.txt'), 'w') as log:
+        for point_index, set_volt in enumerate(volt_array):
+            out_point = scan_voltage_point(k, osc, set_volt, timer, scale_cache=scale_cache, log=log,
+                settle_time=0.5*dwell_scale, current_acquisition_time=2*dwell_scale,
+                current_sleep_time=0.1*dwell_scale, wf_buffer=wf_buffer, wf_store=wf_store)
+            if out_point is None:
+                break
+            out[point_index] = out_point
+    if wf_store is not None:
+        wf_store.close()
+    with timer.stage('disk write'):
+        np.savetxt(os.path.join(work_dir, 'bench.csv'), out, delimiter=",")
+    for column, name in (('std_delay', 'jitter'), ('mean_slew', 'slew'), ('mean_amp', 'amp'),
+                         ('mean_area', 'area'), ('mean_low', 'low'), ('count', 'count'),
+                         ('mean_current', 'current')):
+        with timer.stage('plotting'):
+            plot_voltage_grid(volt_array, out[:, summary_columns.index(column)],
+                os.path.join(work_dir, name+'.png'))
+    result = timer.summary()
+    ramp_voltage(k, target_voltage = 0)
+    k.turn_off()
+    return result
+
+### TwoDScan raster through RasterScan, with the live map drawn as TwoDScan.plot does
+def benchmark_raster_scan(work_dir, h_points=10, v_points=10, step=40, averages=10,
+        channels=(1,), pipelined=True, plot=True, serpentine=False, adaptive=False, max_fps=10):
+    import threading
+    from RTP044_oscilloscope import rhodeschwarz_rtp044
+    from motion_stage_driver import MotionStageController
+    from raster_scan import RasterScan, open_scan_file
+    from stage_timer import StageTimer
+    from live_map import MapRenderer
+
+    m = MotionStageController()
+    osc = rhodeschwarz_rtp044()
+    udist = {}
+    start = {}
+    for axis, device in m.devices.items():
+        start[axis], udist[axis] = m.get_position(device)
+    spaces = {'L': [start['L']],
+              'H': list(range(start['H'], start['H']+h_points*step, step)),
+              'V': list(range(start['V'], start['V']+v_points*step, step))}
+    # Return trips as built by TwoDScan.get_scanning_space
+    h_span = spaces['H'][-1]-spaces['H'][0]
+    h_return = np.linspace(spaces['H'][-1], spaces['H'][0], int(h_span/100)).astype(int) if h_span > 200 else None
+    v_span = spaces['V'][-1]-spaces['V'][0]
+    v_return = np.linspace(spaces['V'][-1], spaces['V'][0], int(v_span/5)).astype(int) if v_span > 10 else None
+
+    figure = Figure(figsize=(3, 3))             # 300x300 canvas as in TwoDScan
+    canvas = FigureCanvasAgg(figure)
+    renderer = MapRenderer(figure, canvas, max_fps=max_fps)
+    def draw(data, l):                          # Throttled as LiveMapView, without the Qt thread hop
+        if renderer.due():
+            renderer.draw(data, l)
+
+    samples = osc.get_timebase().points
+    final_data = open_scan_file(os.path.join(work_dir, 'bench_scan.npy'), spaces, samples, len(channels))
+    timer = StageTimer()
+    scan = RasterScan(m, osc, list(channels), averages, threading.Event(), pipelined=pipelined,
+        on_pixel=draw if plot else None, timer=timer, serpentine=serpentine)
+    if adaptive:
+        scan.run_adaptive(spaces, final_data, udist)
+    else:
+        scan.run(spaces, h_return, v_return, final_data, udist)
+    del final_data
+    return timer.summary()
+
+def print_summary(name, summary, previous=None):
+    print('{}: {} points in {:.1f} s, {:.0f} points/h'.format(
+        name, summary['points'], summary['elapsed'], summary['points_per_hour']), end='')
+    if previous:
+        print(' (was {:.0f} points/h)'.format(previous['points_per_hour']), end='')
+    print()
+    for stage, s in sorted(summary['stages'].items(), key=lambda x: -x[1]['total']):
+        line = '  {:<18} {:9.3f} s  {:5.1f} %  mean {:.4f} s'.format(
+            stage, s['total'], 100*s['fraction'], s['mean'])
+        if previous and stage in previous['stages']:
+            line += '  ({:+.1f} %)'.format(100*(s['mean']/previous['stages'][stage]['mean']-1))
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scan throughput benchmark on simulated instruments')
+    parser.add_argument('--label', default='', help='Name stored with the results')
+    parser.add_argument('--output', default=None, help='JSON results file')
+    parser.add_argument('--compare', default=None, help='Earlier JSON results to compare with')
+    parser.add_argument('--latency', default=None, help='JSON file overriding the latency models')
+    parser.add_argument('--latency-scale', type=float, default=None, help='Scales all latencies, 0 disables')
+    parser.add_argument('--scan', choices=['voltage', 'raster', 'both'], default='both')
+    parser.add_argument('--voltage-points', type=int, default=20)
+    parser.add_argument('--voltage-step', type=float, default=-5)
+    parser.add_argument('--dwell-scale', type=float, default=0.1,
+        help='Scales the settle and current sampling waits of the voltage scan')
+    parser.add_argument('--no-waveforms', action='store_true', help='Voltage scan without saved waveforms')
+    parser.add_argument('--raster', default='10x10', help='H x V points of the raster')
+    parser.add_argument('--raster-step', type=int, default=40)
+    parser.add_argument('--averages', type=int, default=10)
+    parser.add_argument('--sequential', action='store_true', help='Raster without pipelining')
+    parser.add_argument('--no-plot', action='store_true', help='Raster without the live map')
+    parser.add_argument('--max-fps', type=float, default=10, help='Live map frame rate cap')
+    parser.add_argument('--serpentine', action='store_true', help='Serpentine raster, no return trips')
+    parser.add_argument('--adaptive', action='store_true', help='Adaptive quadtree scan of the raster area')
+    parser.add_argument('--trace', action='store_true', help='Trace the instrument commands')
+    args = parser.parse_args(argv)
+    if args.trace:
+        os.environ['TCT_TRACE'] = '1'
+    from scpi_trace import tracer
+
+    results = {'label': args.label, 'version': source_version(),
+               'timestamp': time.strftime("%Y%m%d-%H%M%S"), 'config': vars(args),
+               'latency': load_latency_models(args.latency, args.latency_scale),
+               'latency_scale': float(os.environ.get('TCT_SIM_LATENCY', '1'))}
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.scan in ('voltage', 'both'):
+            simulated_instruments.bench.__init__()      # Fresh bench for every scan
+            results['voltage_scan'] = benchmark_voltage_scan(work_dir, points=args.voltage_points,
+                step=args.voltage_step, dwell_scale=args.dwell_scale, save_waveforms=not args.no_waveforms)
+            print_summary('Voltage scan', results['voltage_scan'], previous.get('voltage_scan'))
+            if args.trace:
+                print(tracer.report())
+                results['voltage_scan']['trace'] = tracer.histograms()
+                tracer.clear()
+        if args.scan in ('raster', 'both'):
+            simulated_instruments.bench.__init__()
+            h_points, v_points = (int(n) for n in args.raster.lower().split('x'))
+            results['raster_scan'] = benchmark_raster_scan(work_dir, h_points=h_points, v_points=v_points,
+                step=args.raster_step, averages=args.averages, pipelined=not args.sequential,
+                plot=not args.no_plot, serpentine=args.serpentine, adaptive=args.adaptive,
+                max_fps=args.max_fps)
+            print_summary('Raster scan', results['raster_scan'], previous.get('raster_scan'))
+            if args.trace:
+                print(tracer.report())
+                results['raster_scan']['trace'] = tracer.histograms()
+                tracer.clear()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Results saved to {}'.format(args.output))
+    return results
+
+if __name__ == '__main__':
+    main()
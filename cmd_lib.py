@@ -1,102 +1,290 @@
-import sys,traceback,time,random,os,shutil,datetime
+import sys,traceback,time,random,os,shutil,datetime,json
+from contextlib import nullcontext
 import numpy as np
 import matplotlib.pyplot as plt
 
-from Keithley_control import keithley_2410
+from Keithley_control import keithley_2410, reading_in_compliance
 from RTP044_oscilloscope import rhodeschwarz_rtp044
 from QD_Laser_control import QD_Laser
 from motion_stage_driver import MotionStageController   # XX May have problem when disconnected
+from stage_timer import StageTimer
+from scpi_trace import tracer
+from pulse_features import extract_features, summarize
+from scan_summary import summary_columns, plot_voltage_grid
 
 ### ------------------------------------------------------------------------------------
 
-### Ramps the Keithley voltage to a target in steps of 20 V. Tagert must be negative (or is made so)
+### Ramps the Keithley voltage to a target in steps of up to max_step V. Target must be negative (or is made so)
 ### Override allows positive voltages to be selected
-def ramp_voltage(k, target_voltage, override=False):
+### After each step the next one is taken as soon as the current has settled (|dI/dt| below
+### settle_threshold in A/s) or settle_timeout has passed. The SMU source delay makes every
+### reading wait for the source to settle, auto delay is restored when the ramp ends.
+### Compliance is checked on every reading and aborts the ramp straight away.
+def ramp_voltage(k, target_voltage, override=False, max_step=20, settle_threshold=5e-9,
+        settle_interval=0.05, settle_timeout=1, source_delay=0.05):
+    reading = k.measure()
+    init_voltage = reading.voltage
     if target_voltage is None:
-        target_voltage = k.get_voltage()
+        target_voltage = init_voltage
     elif target_voltage > 0 and override==False:        # Without override, only negative voltages supported
         print('Only non-positive target voltages allowed. Correct your value or set override=True')
         target_voltage = -target_voltage                # Changes target to negative voltage
-    init_voltage = k.get_voltage()
     voltage_diff = target_voltage - init_voltage
     if voltage_diff == 0:
         msg = r'Voltage kept at {}V'.format(init_voltage)
         print(msg)
-    else:
-        volt_step = 20
+        return msg
+    k.set_source_delay(source_delay)         # Only for the ramp, auto delay restored below
+    try:
         step_sign = int(abs(voltage_diff)/voltage_diff)
-        steps = 1
-        current_voltage = k.get_voltage()
-        while abs(current_voltage-target_voltage) > volt_step:
-            k.set_voltage(current_voltage + step_sign*volt_step)
-            # XX Compliance check would be advantageous
-            time.sleep(1)
-            current_voltage = k.get_voltage()
+        set_point = init_voltage
+        steps = 0
+        while set_point != target_voltage:
+            if abs(target_voltage-set_point) > max_step:
+                set_point = set_point + step_sign*max_step
+            else:
+                set_point = target_voltage
+            k.set_voltage(set_point, special=override)
             steps += 1
-        k.set_voltage(target_voltage)
-        current_voltage = k.get_voltage()
-        msg = r'Voltage changed from {}V to {}V over {} steps'.format(init_voltage, current_voltage, steps)
+            reading = wait_for_settle(k, settle_threshold, settle_interval, settle_timeout)
+            if reading_in_compliance(reading):
+                msg = r'Compliance reached at {}V ({}A), ramp from {}V aborted after {} steps'.format(
+                    reading.voltage, reading.current, init_voltage, steps)
+                print(msg)
+                return msg
+        msg = r'Voltage changed from {}V to {}V over {} steps'.format(init_voltage, reading.voltage, steps)
         print(msg)
-    return msg
+        return msg
+    finally:
+        k.set_source_delay(None)           # Later readings and buffered sampling use auto delay
+
+## Reads the SMU until |dI/dt| < threshold (A/s), compliance or timeout, returns the last reading
+def wait_for_settle(k, threshold, interval=0.05, timeout=1):
+    start = time.time()
+    previous, previous_time = k.measure(), time.time()
+    while not reading_in_compliance(previous) and time.time()-start < timeout:
+        time.sleep(interval)
+        reading, reading_time = k.measure(), time.time()
+        slope = abs(reading.current-previous.current)/(reading_time-previous_time)
+        previous, previous_time = reading, reading_time
+        if slope < threshold:
+            break
+    return previous
+
+### Per-sensor memory of the V/div found by autoscale at each bias, kept as JSON so that
+### later points and repeat scans of the same DUT start at the right setting
+class ScaleCache():
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.scales = {}
+        if os.path.isfile(file_name):
+            with open(file_name) as f:
+                self.scales = {float(v): s for v, s in json.load(f).items()}
+
+    ## Returns (scale, exact) for the nearest cached bias, (None, False) if empty
+    def lookup(self, bias):
+        if not self.scales:
+            return None, False
+        nearest = min(self.scales, key=lambda v: abs(v-bias))
+        return self.scales[nearest], nearest == round(bias, 3)
+
+    ## Largest scale stored for any bias, None if empty
+    def largest(self):
+        return max(self.scales.values()) if self.scales else None
+
+    def store(self, bias, scale):
+        self.scales[round(bias, 3)] = scale
+        with open(self.file_name, 'w') as f:
+            json.dump({str(v): s for v, s in sorted(self.scales.items())}, f, indent=1)
+
+## Write batch on scopes that support it (RTP044), otherwise a no-op
+def osc_batch(osc):
+    return osc.batch() if hasattr(osc, 'batch') else nullcontext()
+
+## Averaged waveform amplitude, plus the extremes of the single waveforms for clipping checks
+def measure_amplitude(osc, channel=2, samples=10):
+    if hasattr(osc, 'acquire_segments'):
+        data = osc.acquire_segments(samples, channel=channel)  # Distinct triggers, one transfer
+    else:
+        first = np.array(osc.read_waveform(channel=channel))
+        data = np.empty((samples, len(first)))
+        data[0] = first
+        for wave_no in range(1, samples):
+            osc.run()
+            data[wave_no] = osc.read_waveform(channel=channel)
+    mean = np.mean(data,axis=0)
+    return np.max(mean)-np.min(mean), np.max(data), np.min(data)
 
 ## Autoscales the oscilloscope yaxis
-def autoscale(osc,depth=0):
-    if depth>30:
-        print(r'Cannot set scale after {} steps'.format(depth))
-        return False
+## The amplitude is measured once and the V/div computed from it directly. A clipped
+## signal only gives a lower bound, so the scale jumps to the largest cached scale or the
+## full range of the channel and is measured once more, 1-2 acquisitions in most cases.
+## With a cache and bias the search starts from the cached scale. A cached entry for
+## this exact bias is verified with one acquisition, or used as-is with trust_cache.
+## The scale left on the scope has always been measured and is stored in the cache.
+def autoscale(osc, cache=None, bias=None, trust_cache=False, max_acquisitions=4):
     min_size = 4        # Minimum number of divisions taken by the signal amplitude
     max_size = 6        # Maximum number of divisions taken by the signal amplitude
+    target_size = 5     # Number of divisions aimed at when a new scale is computed
     min_scale = 0.015   # Set minimum allowed scale (in V)
-    upscale = 5         # Change scale such that the signal is 'upscale' times larger
-    downscale = 1.5     # Change scale such that the signal is 'downscale' times smaller
+    max_scale = 1.0     # Full range of the RTP044 channel at 50 Ohm (in V)
+    clip_margin = 0.02  # Fraction of a division from the screen edge counted as clipped
     base_pos = 3        # Number of divisons the base is shifted downwards from the centre (set <5)
                         # Watch out! max_size - base_pos < 5 Otherwise the amplitude will not fit 
-    
-    current_scale = float(osc.get_scale(channel=2))
-    osc.set_offset(val=3*current_scale,channel=2)       # Fixes the base, suitable for unipolar signal
-    
     sample_wfs = 10     # Sample size of average waveform used for scaling
-    data = np.array(osc.read_waveform(channel=2))
-    for wave_no in range(sample_wfs-1):
-        osc.run()
-        waveform = np.array(osc.read_waveform(channel=2))
-        data = np.vstack((data, waveform))
-    data = np.mean(np.array(data),axis=0)
-    amp = (np.max(data)-np.min(data))
+
+    init_scale = float(osc.get_scale(channel=2))
+    current_scale = init_scale
+    cached_scale, exact = (None, False)
+    if cache is not None and bias is not None:
+        cached_scale, exact = cache.lookup(bias)
+        if cached_scale is not None:
+            current_scale = cached_scale
     
-    if amp < min_size*current_scale:
-        if current_scale <= min_scale:
-            osc.set_scale(min_scale, channel = 2)
-            smallest_scale_reached = True
-            msg = r'Scale limit rached at {}V in {} steps'.format(current_scale, depth)
+    fitted = False
+    for acquisition in range(1, max_acquisitions+1):
+        with osc_batch(osc):                    # Offset and scale in one message
+            osc.set_offset(val=base_pos*current_scale,channel=2)    # Fixes the base, suitable for unipolar signal
+            osc.set_scale(current_scale, channel = 2)
+        if exact and trust_cache:
+            msg = r'Scale set to {}V from cache'.format(current_scale)
             print(msg)
             return msg
-        else:
-            new_scale = max(round(amp/upscale, 3),min_scale)  # Max to give opportunity to stop at min scale
-            osc.set_scale(new_scale, channel = 2)
-            return autoscale(osc,depth=depth+1)
-    elif amp > max_size*current_scale:
-        new_scale = round(current_scale*downscale, 3)
-        osc.set_scale(new_scale, channel = 2)
-        return autoscale(osc,depth=depth+1)
+        amp, wf_max, wf_min = measure_amplitude(osc, channel=2, samples=sample_wfs)
+        screen_top = (5+base_pos-clip_margin)*current_scale
+        screen_bottom = -(5-base_pos-clip_margin)*current_scale
+        if wf_max >= screen_top or wf_min <= screen_bottom:
+            if current_scale >= max_scale or acquisition == max_acquisitions:
+                break                           # Left at the last measured scale
+            largest = cache.largest() if cache is not None else None
+            current_scale = largest if largest is not None and largest > current_scale else max_scale
+            continue
+        fitted = True
+        if not min_size*current_scale <= amp <= max_size*current_scale:
+            new_scale = min(max(round(amp/target_size, 3), min_scale), max_scale)
+            if new_scale != current_scale:
+                with osc_batch(osc):
+                    osc.set_offset(val=base_pos*new_scale,channel=2)
+                    osc.set_scale(new_scale, channel = 2)
+                current_scale = new_scale       # Unclipped amplitude scales exactly, no re-measure
+        break
+    
+    if cache is not None and bias is not None:
+        cache.store(bias, current_scale)
+    if not fitted:
+        msg = r'Cannot set scale after {} acquisitions, left at {}V'.format(acquisition, current_scale)
+    elif current_scale == init_scale:
+        msg = r'Scale kept at {}V'.format(current_scale)
     else:
-        if (depth==0):
-            msg = r'Scale kept at {}V'.format(current_scale)
-            print(msg)
-        else:
-            msg = r'Scale changed to {}V in {} steps'.format(current_scale, depth)
-            print(msg)
-        return msg
+        msg = r'Scale changed to {}V in {} acquisitions'.format(current_scale, acquisition)
+    print(msg)
+    return msg
+
+### Preallocated (record_length, 1+samples) array: column 0 is the timebase, the other
+### columns one waveform each. Columns are contiguous (Fortran order), so filling a
+### waveform is a plain copy and the array saves as-is without a transpose.
+### Reuse one buffer across voltage points, it is only reallocated if the shape changes.
+class AcquisitionBuffer():
+
+    def __init__(self, record_length, samples, dtype=np.float64):
+        self.dtype = dtype
+        self.allocate(record_length, samples)
+
+    def allocate(self, record_length, samples):
+        self.data = np.empty((int(record_length), int(samples)+1), dtype=self.dtype, order='F')
+        self.timebase = self.data[:, 0]
+        self.waveforms = self.data[:, 1:]
+
+    def ensure(self, record_length, samples):
+        if self.data.shape != (int(record_length), int(samples)+1):
+            self.allocate(record_length, samples)
+        return self
+
+    @property
+    def record_length(self):
+        return self.data.shape[0]
+
+    @property
+    def samples(self):
+        return self.data.shape[1]-1
+
+## Returns the timebase and samples waveforms as columns
+## Segmented mode guarantees samples distinct triggers, free running may re-read one
+## Pass buffer to fill an AcquisitionBuffer in place instead of allocating per call
+def wave_acquire(osc,samples=10,segmented=True,buffer=None):
+    timebase = osc.read_timebase()
+    if buffer is None:
+        buffer = AcquisitionBuffer(len(timebase), samples)
+    else:
+        buffer.ensure(len(timebase), samples)
+    buffer.timebase[:] = timebase
+    if segmented and hasattr(osc, 'acquire_segments'):
+        buffer.waveforms[:] = osc.acquire_segments(samples, channel=2).T
+    else:
+        osc.run()
+        for i in range(0,samples):
+            buffer.waveforms[:,i] = osc.read_waveform(channel=2)
+    return buffer.data
+
+### One point of the voltage scan, shared by execute_TCT_scan_voltage.py and the benchmark
+### Returns the output row (see out_size in the script) or None if the SMU went into compliance
+### Log messages are written to log (open file) if given. Every stage is timed on timer.
+def scan_voltage_point(k, osc, set_volt, timer, scale_cache=None, log=None, settle_time=0.5,
+        current_acquisition_time=2, current_sleep_time=0.1, wf_buffer=None, wf_store=None):
+    tracer.mark_point()                         # Instrument calls per point, if traced
+    with timer.stage('ramp'):
+        msg = ramp_voltage(k, target_voltage = set_volt)
+    if log is not None:
+        log.write(msg+'\n')
+    if k.in_compliance(max_age=1):              # Status of the last ramp reading
+        return None
+    with timer.stage('autoscale'):
+        msg = autoscale(osc, cache=scale_cache, bias=set_volt)   # Starts from the scale cached for this DUT
+    if log is not None:
+        log.write(msg+'\n')
+    with timer.stage('settle'):
+        time.sleep(settle_time)                 # Such that the signal can settle if averaged
+        osc.clear_meas_groups(groups = (1,2,3,4,5))     # One command for all groups
+
+    current_meas_size = int(current_acquisition_time/current_sleep_time)
+    with timer.stage('current sampling'):
+        k.start_buffered(count=current_meas_size, interval=current_sleep_time)   # Sampled on the SMU
+        osc.run()                               # Data taking started
+        time.sleep(current_acquisition_time)    # Scope statistics and current sampling run together
+        current_array = k.fetch_buffered()['current']   # Current measured in Amps
+        osc.stop()                              # Data taking stopped
+
+    with timer.stage('measurement fetch'):
+        op_volt      = k.get_voltage()
+        stats = osc.fetch_statistics(groups=(1,2,3,4,5), fields=('AVG','STDDev','EVTCount'))
+    # Pre-set OSC groups: 1 delay trig 50% - signal 50%, 2 slew 49%-51% range, 3 amplitude,
+    # 4 area to 0 V level, 5 low
+    point = {'op_volt': op_volt, 'count': int(stats['evtcount'][4]),
+             'mean_current': np.mean(current_array), 'std_current': np.std(current_array),
+             'current_meas_size': current_meas_size}
+    for i, meas in enumerate(('delay', 'slew', 'amp', 'area', 'low')):
+        point['mean_'+meas] = stats['avg'][i]
+        point['std_'+meas]  = stats['stddev'][i]
+    out_point = [point[c] for c in summary_columns]     # Row of the summary CSV, see scan_summary
 
-def wave_acquire(osc,samples=10):
-    osc.run()
-    data = np.array(osc.read_timebase())[:-1]
-    for i in range(0,samples):
-        values = osc.read_waveform(channel=2)
-        values = np.array(values)
-        data = np.vstack([data, values])
-    data = np.transpose(data)
-    return data
+    # XX separate process for now, can add above next, this is to get approx save stats for above
+    if wf_store is not None:
+        with timer.stage('waveform transfer'):
+            wave_acquire(osc, samples=wf_buffer.samples, buffer=wf_buffer)   # Distinct triggers, segmented
+        with timer.stage('feature extraction'):
+            features = extract_features(wf_buffer.waveforms.T, wf_buffer.timebase)
+        with timer.stage('disk write'):
+            wf_store.append(set_volt, wf_buffer.waveforms, features)
+        if log is not None:
+            summary = summarize(features)
+            log.write('Waveforms: amplitude {:.4g} V, rise time {:.4g} s, CFD 50 % jitter {:.4g} s\n'.format(
+                summary['amplitude']['mean'], summary['rise_time']['mean'], summary['cfd_50']['std']))
+    # XX potentially use this to record 1000 points and shorten keithley
+    # XX acq time to 0.01 and just do a quick one beforehand
+    # XX also uses 125 fs resolution, overkill and also large files as a result
+    timer.point_done()
+    return out_point
 
 def osc_meta(osc, file = None, first_line = None):
     f = open(file, 'a')
@@ -115,14 +303,10 @@ def keithley_meta(k, file = None, first_line = None):
     
     f.write(k.device.query('*IDN?')) 
     f.write('\nActive terminal: '+str(k.which_terminal()))
-    f.write('Operating voltage [V] '+str(k.get_voltage())+'\n')
+    f.write('Operating voltage [V] '+str(k.measure(max_age=1).voltage)+'\n')
     # XX write definition for the following, also used later
-    current_list = []
     current_meas_size = 10
-    for current_meas in range(current_meas_size):
-        current_list.append(k.get_current())    # Current measured in Amps
-        time.sleep(0.1)
-    current_array = np.array(current_list)
+    current_array = k.acquire_buffered(count=current_meas_size, interval=0.1)['current']  # in Amps
     f.write('Average current [A]   %.3e\n' % np.mean(current_array))
     f.write('Stdev current [A]     %.3e\n' % np.std(current_array))
     f.write('Measurement count     '+str(current_meas_size)+'\n')
@@ -136,12 +320,13 @@ def laser_meta(l, file = None, first_line = None):
     if not first_line==None:
         f.write(first_line+'\n')                # Can pass first line of the report
         
+    snapshot = l.snapshot()                     # All registers in one pass
     f.write('\nQD Laser Control Settings\n')
-    c_report = l.control_report()
+    c_report = l.control_report(snapshot)
     for line in c_report:
         f.write(line+'\n')
     f.write('\nQD Laser Monitor Values\n')
-    m_report = l.monitor_report()
+    m_report = l.monitor_report(snapshot)
     for line in m_report:
         f.write(line+'\n')
     
@@ -6,16 +6,15 @@ from Keithley_control import keithley_2410
 from RTP044_oscilloscope import rhodeschwarz_rtp044
 from QD_Laser_control import QD_Laser
 
-from cmd_lib import ramp_voltage, autoscale, wave_acquire
+from cmd_lib import ramp_voltage, AcquisitionBuffer, ScaleCache, StageTimer
+from cmd_lib import scan_voltage_point, plot_voltage_grid, summary_columns
 from cmd_lib import osc_meta, keithley_meta, laser_meta
+from waveform_store import WaveformStore
+from scpi_trace import tracer, tracing_enabled
 
 def save_grid(grid, name, label=''):        # Misnomer - relict from 2D_scan
-    plt.subplot()
-    plt.plot(-volt_array, grid)
-    plt.xlabel('Bias voltage [V]')
-    plt.ylabel(label)
-    plt.savefig('{}/{}_{}.png'.format(path, output_file, name), bbox_inches='tight')
-    plt.clf()
+    with timer.stage('plotting'):
+        plot_voltage_grid(volt_array, grid, '{}/{}_{}.png'.format(path, output_file, name), label)
 
 ### ------------------------------------------------------------------------------------
 
@@ -45,6 +44,7 @@ try:
 except OSError as error: 
     print(error)
 # XX Have another file - log, which will show the same thing as is outputted by print?
+scale_cache = ScaleCache(os.path.join(output_path, 'scale_cache_{}.json'.format(output_file)))
 
 ### Initialization of RTP044 oscilloscope
 osc.run()
@@ -95,72 +95,33 @@ current_grid = grid.copy()
 
 ### Initialize array for output
 ### out_size is 1 (voltage) + 2*number of meas + 1 (wave counts) + 3 (current, std, count)
-out_size = 15       
-out = np.empty((0,out_size))      
+out_size = len(summary_columns)     # Column layout in scan_summary
+out = np.full((total_points,out_size), np.nan)  # Preallocated, rows filled per point
+done_points = 0
+wf_samples = 10                                 # Waveforms saved per point
+wf_buffer = AcquisitionBuffer(len(osc.read_timebase()), wf_samples)   # Reused every point
+save_waveforms = True
+if save_waveforms:                              # One chunked file per run, appended per point
+    wf_store = WaveformStore('{}/wf_{}.h5'.format(path, output_file), osc.get_timebase(), wf_samples,
+        settings = {'name': output_file, 'timestamp': timestr, 'channel': 2,
+                    'timescale': osc.get_timescale(), 'timedelay': osc.get_timedelay(),
+                    'resolution': osc.get_resolution()})
 
 # XX move the laser to a better position before starting measurement? 
 # XX problem with initial_position used later, would need to have a new variable
 ### Main loop - also keeps track of time
 g = open(log_temp_file, 'a')
+timer = StageTimer()                            # Per-stage breakdown, saved with the data
 start_time = time.time()
 for set_volt in volt_array:
     point_start_time = time.time()
-    msg=ramp_voltage(k, target_voltage = set_volt)
-    g.write(msg+'\n')
-    if k.in_compliance():
+    out_point = scan_voltage_point(k, osc, set_volt, timer, scale_cache=scale_cache, log=g,
+        settle_time=0.5, current_acquisition_time=2, current_sleep_time=0.1,
+        wf_buffer=wf_buffer, wf_store=wf_store if save_waveforms else None)
+    if out_point is None:                       # SMU in compliance
         break
-    msg=autoscale(osc)                       # XX autoscale does not seem to be working very well
-                                             # Mainly sets scale too small and then fails to adjust
-                                             # leading to signals too big for the scope
-    g.write(msg+'\n')
-    time.sleep(0.5)                         # Such that the signal can settle if averaged
-    for group_no in range(1,6):
-        osc.clear_meas(group = group_no)    # XX better command to clear all groups?
-        
-    current_acquisition_time = 2                # Current acquision time at one point (s)
-        # XX the above is not so useful if also wave_acquire is used later
-    current_sleep_time = 0.1                    # Time between current measurements
-    current_list = []
-    current_meas_size = int(current_acquisition_time/current_sleep_time)
-    osc.run()                                   # Data taking started
-    for current_meas in range(current_meas_size):
-        current_list.append(k.get_current())    # Current measured in Amps
-        time.sleep(current_sleep_time)
-    current_array = np.array(current_list)
-    osc.stop()                                  # Data taking stopped
-
-    op_volt      = k.get_voltage()
-    mean_delay   = float(osc.get_meas(group=1))     # Pre-set OSC for trig 50% - signal 50%
-    std_delay    = float(osc.get_meas_std(group=1))
-    mean_slew    = float(osc.get_meas(group=2))     # Pre-set OSC for 49%-51% range
-    std_slew     = float(osc.get_meas_std(group=2))
-    mean_amp     = float(osc.get_meas(group=3))
-    std_amp      = float(osc.get_meas_std(group=3))
-    mean_area    = float(osc.get_meas(group=4))     # Pre-set OSC for 0 V level
-    std_area     = float(osc.get_meas_std(group=4))
-    mean_low     = float(osc.get_meas(group=5))
-    std_low      = float(osc.get_meas_std(group=5))
-    count        = int(osc.get_meas_count(group=5))
-    mean_current = np.mean(current_array)
-    std_current  = np.std(current_array)
-    
-    out_point = [op_volt,  \
-                 mean_delay,   std_delay,   mean_slew,   std_slew, \
-                 mean_amp,     std_amp,     mean_area,   std_area, \
-                 mean_low,     std_low,     count, \
-                 mean_current, std_current, current_meas_size]
-    
-    # XX separate process for now, can add above next, this is to get approx save stats for above
-    save_waveforms = True
-    if save_waveforms:
-        osc.run()
-        wfs=wave_acquire(osc, samples=10)          # Gets waveforms, however not the same data!
-        osc.stop()  
-        np.savetxt('{}/wf_{}_{}V.csv'.format(path, output_file, abs(set_volt)), 
-            wfs, delimiter=',', fmt='%.4e')
-    # XX potentially use this to record 1000 points and shorten keithley 
-    # XX acq time to 0.01 and just do a quick one beforehand
-    # XX also uses 125 fs resolution, overkill and also large files as a result
+    op_volt, mean_delay, std_delay, mean_slew, std_slew, mean_amp, std_amp, \
+        mean_area, std_area, mean_low, std_low, count, mean_current = out_point[:13]
     
     point_index, = np.where(volt_array == set_volt)
     point_index = point_index[0]
@@ -178,7 +139,7 @@ for set_volt in volt_array:
     print(msg)
     g.write(msg+'\n\n')
     print(out_point)
-    out = np.vstack((out, np.array(out_point)))
+    out[point_index] = out_point
     
     jitter_grid[point_index]  = std_delay
     slew_grid[point_index]    = mean_slew     
@@ -190,6 +151,8 @@ for set_volt in volt_array:
 msg = ramp_voltage(k, target_voltage = 0)
 g.write(msg+'\n')
 g.close()
+if save_waveforms:
+    wf_store.close()
         
 acq_time=time.time()-start_time
 acq_time_hms=datetime.timedelta(seconds=round(acq_time))
@@ -213,7 +176,8 @@ ramp_voltage(k, target_voltage = 0)
 k.turn_off()
 
 ### Saving data and metadata
-np.savetxt('{}/{}.csv'.format(path, output_file), out, delimiter=",")
+with timer.stage('disk write'):
+    np.savetxt('{}/{}.csv'.format(path, output_file), out[:done_points], delimiter=",")
 meta_dest_file='{}/{}_meta.txt'.format(path, output_file)
 shutil.copyfile(meta_temp_file, meta_dest_file, follow_symlinks=True)
 log_dest_file='{}/{}_log.txt'.format(path, output_file)
@@ -227,4 +191,10 @@ save_grid(grid=amp_grid,    name='amp',    label='Amplitude [V]')
 save_grid(grid=area_grid,   name='area',   label='Area [Vs]')
 save_grid(grid=low_grid,    name='low',    label='Low [V]')
 save_grid(grid=count_grid,  name='count',  label='Wave count')
-save_grid(grid=current_grid,name='current',label='Current [A]')
\ No newline at end of file
+save_grid(grid=current_grid,name='current',label='Current [A]')
+
+print(timer.report())
+timer.save('{}/{}_timing.json'.format(path, output_file), name=output_file, timestamp=timestr)
+if tracing_enabled():                           # TCT_TRACE=1, instrument command latencies
+    print(tracer.report())
+    tracer.save('{}/{}_trace.json'.format(path, output_file))
@@ -0,0 +1,67 @@
+import time
+import numpy as np
+
+### Live amplitude map of the raster scans
+### One AxesImage is kept and updated with set_data. Frames are blitted over a background
+### saved after the last full redraw, which only happens when the grid shape or the L plane
+### changes (or the canvas redraws itself, e.g. on resize or zoom). Grids larger than the
+### canvas are decimated to at most one sample per canvas pixel before display.
+### MapRenderer does no threading of its own, LiveMapView in FindPixelApp calls it from the
+### GUI thread.
+
+def decimate(data,max_rows,max_cols):
+	row_step=max(1,-(-data.shape[0]//max(max_rows,1)))
+	col_step=max(1,-(-data.shape[1]//max(max_cols,1)))
+	return data[::row_step,::col_step]
+
+class MapRenderer():
+	def __init__(self,figure,canvas,max_fps=10,cmap='jet'):
+		self.figure=figure
+		self.canvas=canvas
+		self.cmap=cmap
+		self.min_interval=1.0/max_fps if max_fps else 0.0
+		self.last_draw=0.0
+		self.ax=figure.add_subplot(111)
+		self.image=None
+		self.shape=None
+		self.l=None
+		self.background=None
+		self.canvas.mpl_connect('draw_event',self.on_draw)
+
+	# True once min_interval has passed since the last frame
+	def due(self):
+		return time.perf_counter()-self.last_draw>=self.min_interval
+
+	def draw(self,data,l):
+		self.last_draw=time.perf_counter()
+		width,height=self.canvas.get_width_height()
+		shown=np.array(decimate(data,height,width),dtype=float)
+		finite=shown[np.isfinite(shown)]
+		clim=(finite.min(),finite.max()) if finite.size else (0,1)
+		if self.image is None or data.shape!=self.shape or l!=self.l:
+			self.ax.clear()
+			self.image=self.ax.imshow(shown,cmap=self.cmap,animated=True,
+				extent=(-0.5,data.shape[1]-0.5,data.shape[0]-0.5,-0.5)) #axes stay in pixel indices
+			self.image.set_clim(*clim)
+			self.ax.set_title('L: '+str(l))
+			self.shape=data.shape
+			self.l=l
+			self.canvas.draw() #saves the background and draws the image, see on_draw
+			return
+		self.image.set_data(shown)
+		self.image.set_clim(*clim)
+		self.blit()
+
+	def blit(self):
+		if self.background is None:
+			self.canvas.draw()
+			return
+		self.canvas.restore_region(self.background)
+		self.ax.draw_artist(self.image)
+		self.canvas.blit(self.ax.bbox)
+
+	# After every full redraw: background without the (animated) image, then the image on top
+	def on_draw(self,event):
+		self.background=self.canvas.copy_from_bbox(self.ax.bbox)
+		if self.image is not None:
+			self.ax.draw_artist(self.image)
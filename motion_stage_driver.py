@@ -1,6 +1,7 @@
 from ctypes import *
 import time
 import os
+import threading
 import sys
 import platform
 import tempfile
@@ -22,23 +23,42 @@ if platform.system() == "Windows":
         os.add_dll_directory(libdir)
 
 
-try: 
-    from pyximc import *
-except ImportError as err:
-    print ("Can't import pyximc module. The most probable reason is that you changed the relative location of the testpython.py and pyximc.py files. See developers' documentation for details.")
-    exit()
-except OSError as err:
-    print(err)
-    print ("Can't load libximc library. Please add all shared libraries to the appropriate places. It is decribed in detail in developers' documentation. On Linux make sure you installed libximc-dev package.\nmake sure that the architecture of the system and the interpreter is the same")
-    exit()
+from simulated_instruments import simulation_enabled
+
+if simulation_enabled():    # TCT_SIMULATE=1, stand-in for the XIMC library
+    from simulated_instruments import SimulatedXimcLib, Result, EnumerateFlags
+    from simulated_instruments import get_position_t, move_settings_t, controller_name_t, status_t
+    lib = SimulatedXimcLib()
+else:
+    try: 
+        from pyximc import *
+    except ImportError as err:
+        print ("Can't import pyximc module. The most probable reason is that you changed the relative location of the testpython.py and pyximc.py files. See developers' documentation for details.")
+        exit()
+    except OSError as err:
+        print(err)
+        print ("Can't load libximc library. Please add all shared libraries to the appropriate places. It is decribed in detail in developers' documentation. On Linux make sure you installed libximc-dev package.\nmake sure that the architecture of the system and the interpreter is the same")
+        exit()
 
 translation_dict={'8MT30-50':'H','Axis 1':'L','Axis 2':'V'}
 
 		
+# Positions are cached per axis: (position, uposition, time of the reading)
+# The cache is updated by every move, rel_move and get_position and by one low-rate
+# background poll (start_position_service), which only reads axes whose entry is older
+# than the poll interval. Readers such as the GUI use cached_position instead of asking
+# the controller. Listeners are called as listener(device_id, position, uposition) from
+# the thread that updated the cache, whenever a position changes.
 class MotionStageController():
 	def __init__(self):
 		self.big_step_threshold=900
 		self.position_emitters={}
+		self.position_lock=threading.Lock()
+		self.positions={}
+		self.position_listeners=[]
+		self.position_service=None
+		self.position_service_stop=threading.Event()
+		self.last_stop=0.0
 		self.sbuf = create_string_buffer(64)
 		lib.ximc_version(self.sbuf)
 		print("Library version: " + self.sbuf.raw.decode().rstrip("\0"))
@@ -75,7 +95,6 @@ class MotionStageController():
 			self.devices[translation_dict[name]]=lib.open_device(open_name)
 			
 	def define_needed_objects(self):
-		self.x_pos = get_position_t()
 		self.mvst = move_settings_t()
 		
 	def assign_emitter(self,emitter_object):
@@ -85,10 +104,60 @@ class MotionStageController():
 			print('Could not assign emitter!')
 		
 	def get_position(self, device_id):
-		result = lib.get_position(device_id, byref(self.x_pos))
+		x_pos = get_position_t()	# Own buffer, get_position is called from several threads
+		stamp = time.time()
+		result = lib.get_position(device_id, byref(x_pos))
+		self.update_position(device_id, x_pos.Position, x_pos.uPosition, stamp)
+		return x_pos.Position, x_pos.uPosition
+		
+	# stamp is when the position was valid, older readings do not replace newer ones
+	def update_position(self, device_id, position, uposition, stamp=None):
+		if stamp is None:
+			stamp = time.time()
+		with self.position_lock:
+			previous = self.positions.get(device_id)
+			if previous is not None and previous[2] > stamp:
+				return
+			self.positions[device_id] = (position, uposition, stamp)
+			listeners = list(self.position_listeners)
 		if device_id in self.position_emitters:
-			self.position_emitters[device_id].t=self.x_pos.Position
-		return self.x_pos.Position, self.x_pos.uPosition
+			self.position_emitters[device_id].t=position
+		if previous is None or previous[:2] != (position, uposition):
+			for listener in listeners:
+				listener(device_id, position, uposition)
+				
+	# Cached (position, uposition), read from the controller if missing or older than max_age s
+	def cached_position(self, device_id, max_age=None):
+		with self.position_lock:
+			entry = self.positions.get(device_id)
+		if entry is None or (max_age is not None and time.time()-entry[2] > max_age):
+			return self.get_position(device_id)
+		return entry[0], entry[1]
+		
+	def add_position_listener(self, listener):
+		with self.position_lock:
+			self.position_listeners.append(listener)
+			
+	def start_position_service(self, interval=1.0):
+		if self.position_service is not None:
+			return
+		self.position_service_stop.clear()
+		self.position_service = threading.Thread(target=self.poll_positions, args=(interval,), daemon=True)
+		self.position_service.start()
+		
+	def stop_position_service(self):
+		self.position_service_stop.set()
+		if self.position_service is not None:
+			self.position_service.join()
+			self.position_service = None
+			
+	def poll_positions(self, interval):
+		while not self.position_service_stop.wait(interval):
+			for device_id in list(self.devices.values()):
+				with self.position_lock:
+					entry = self.positions.get(device_id)
+				if entry is None or time.time()-entry[2] >= interval:
+					self.get_position(device_id)
 		
 	def get_speed(self, device_id)        :		
 		result = lib.get_move_settings(device_id, byref(mvst))
@@ -113,8 +182,13 @@ class MotionStageController():
 		result = lib.command_wait_for_stop(device_id, interval)
 
 	def move(self, device_id, distance, udistance):
+		start = time.time()
 		result = lib.command_move(device_id, distance, udistance)
 		self.wait_for_stop(device_id)
+		if result == Result.Ok and self.last_stop < start:
+			self.update_position(device_id, distance, udistance)
+		else:	# Interrupted by stopall, the target was not reached
+			self.get_position(device_id)
 		
 	def breakdown_step(self,step):
 		abs_step=abs(step)
@@ -131,10 +205,14 @@ class MotionStageController():
 		self.get_position(device_id)
 		
 	def stopall(self):
+		self.last_stop = time.time()
 		for k,v in self.devices.items():
 			lib.command_stop(v)
+		for k,v in self.devices.items():
+			self.get_position(v)
 
 	def __del__(self):
+		self.position_service_stop.set()
 		for id in self.devices.values():
 			lib.close_device(byref(cast(id, POINTER(c_int))))
 
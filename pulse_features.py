@@ -0,0 +1,111 @@
+import numpy as np
+
+### Vectorized pulse features of waveform batches
+### Waveforms are (N, samples) arrays with one event per row, e.g. AcquisitionBuffer.waveforms.T,
+### WaveformStoreReader.read(voltage).T or a raster scan point without its 3 position samples.
+### Every feature is computed for all events at once with array operations, there is no loop
+### over the events, so the same code runs online in the scan loop and offline over archived runs.
+###
+### Per event:
+###   baseline, noise   mean and std of the first baseline_samples samples in V
+###   amplitude         peak height above the baseline in V, positive for either polarity
+###   peak_time         time of the peak sample in s
+###   rise_time         between the rise_fractions (default 10 % and 90 %) of the amplitude in s
+###   cfd_<percent>     constant fraction time at every fraction in s, e.g. cfd_20, cfd_50
+###   threshold_time    crossing of the threshold in s, 50 % of the amplitude unless a fixed
+###                     threshold in V is given (as the pre-set scope slew group)
+###   slew_rate         dV/dt at the threshold crossing in V/s
+###   charge            integral of the signal over the load impedance in C
+### Crossings are searched backwards from the peak and interpolated linearly between the two
+### samples around the level, an event without a crossing on its rising edge gets NaN.
+
+default_fractions = (0.2, 0.5)
+
+def cfd_name(fraction):
+    return 'cfd_{:g}'.format(100*fraction)
+
+def feature_dtype(fractions=default_fractions):
+    names = ['baseline', 'noise', 'amplitude', 'peak_time', 'rise_time'] \
+        + [cfd_name(f) for f in fractions] + ['threshold_time', 'slew_rate', 'charge']
+    return np.dtype([(name, np.float64) for name in names])
+
+## (x_increment, x_origin) of a Timebase, a time axis array or an x_increment in s
+def time_scale(timebase):
+    if hasattr(timebase, 'x_increment'):
+        return timebase.x_increment, timebase.x_origin
+    axis = np.asarray(timebase, dtype=float)
+    if axis.ndim == 0:
+        return float(axis), 0.0
+    return float(axis[1]-axis[0]), float(axis[0])
+
+## Fractional sample index where every row of signal rises through its level before its peak
+## Returns the index and the slope in V per sample there, NaN where there is no crossing
+def rising_crossing(signal, peak, level):
+    n, samples = signal.shape
+    index = np.arange(samples)
+    below = (signal < level[:, None]) & (index[None, :] < peak[:, None])
+    last = np.where(below, index[None, :], -1).max(axis=1)     # Last sample under the level
+    valid = last >= 0
+    k = np.clip(last, 0, samples-2)
+    rows = np.arange(n)
+    y0 = signal[rows, k]
+    y1 = signal[rows, k+1]
+    slope = y1-y0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        position = k+(level-y0)/slope
+    return np.where(valid, position, np.nan), np.where(valid, slope, np.nan)
+
+## Structured array of feature_dtype(fractions), one entry per row of waveforms
+## polarity: +1, -1 or 'auto' (sign of the larger excursion from the baseline, per event)
+## window: (start, stop) in s of the charge integration, default the whole record
+def extract_features(waveforms, timebase, fractions=default_fractions, polarity='auto',
+        baseline_samples=100, rise_fractions=(0.1, 0.9), threshold=None, window=None, impedance=50.0):
+    waveforms = np.atleast_2d(np.asarray(waveforms, dtype=float))
+    n, samples = waveforms.shape
+    x_increment, x_origin = time_scale(timebase)
+    features = np.empty(n, dtype=feature_dtype(fractions))
+
+    head = waveforms[:, :min(baseline_samples, samples)]
+    baseline = head.mean(axis=1)
+    signal = waveforms-baseline[:, None]
+    if polarity == 'auto':
+        polarity = np.where(signal.max(axis=1) >= -signal.min(axis=1), 1.0, -1.0)
+    signal *= np.broadcast_to(polarity, (n,))[:, None]          # Positive pulses from here on
+
+    peak = signal.argmax(axis=1)
+    amplitude = signal[np.arange(n), peak]
+    features['baseline'] = baseline
+    features['noise'] = head.std(axis=1)
+    features['amplitude'] = amplitude
+    features['peak_time'] = x_origin+x_increment*peak
+
+    def crossing_time(level):
+        position, slope = rising_crossing(signal, peak, level)
+        return x_origin+x_increment*position, slope/x_increment
+
+    low, _ = crossing_time(rise_fractions[0]*amplitude)
+    high, _ = crossing_time(rise_fractions[1]*amplitude)
+    features['rise_time'] = high-low
+    for fraction in fractions:
+        features[cfd_name(fraction)], _ = crossing_time(fraction*amplitude)
+    level = 0.5*amplitude if threshold is None else np.full(n, abs(threshold))
+    features['threshold_time'], features['slew_rate'] = crossing_time(level)
+
+    if window is None:
+        gate = signal
+    else:
+        start, stop = (int(np.clip(np.round((t-x_origin)/x_increment), 0, samples)) for t in window)
+        gate = signal[:, start:stop]
+    features['charge'] = gate.sum(axis=1)*x_increment/impedance
+    return features
+
+## Mean, std and number of valid events of every feature, e.g. the CFD time std is the jitter
+def summarize(features):
+    summary = {}
+    for name in features.dtype.names:
+        values = features[name]
+        valid = values[np.isfinite(values)]
+        summary[name] = {'mean': float(np.mean(valid)) if valid.size else np.nan,
+                         'std': float(np.std(valid)) if valid.size else np.nan,
+                         'count': int(valid.size)}
+    return summary
@@ -0,0 +1,317 @@
+import os
+import time
+import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from stage_timer import StageTimer
+from scpi_trace import tracer
+
+### Raster scan engine used by FindPixelApp.TwoDScan, free of any Qt code
+### In pipelined mode the move to pixel n+1 starts as soon as the scope holds the
+### acquisition of pixel n. Readout, averaging, plotting and saving of pixel n then
+### run in a single worker thread while the stage moves. The next acquisition waits
+### only until the worker has released the scope, not until pixel n is fully processed.
+### In serpentine mode every other row (and every other V plane) is scanned backwards, so
+### there are no return trips. A BacklashModel then shifts the moves made in the negative
+### direction so that both directions land on the same positions.
+
+def get_amplitude(waveform):
+	return np.mean(waveform[0:100])-np.min(waveform)
+
+# Scan output preallocated as a memory-mapped .npy of shape (L,V,H,samples+3,channels)
+# Last 3 samples hold the (h,v,l) position, points not yet scanned are NaN
+def open_scan_file(file_name,spaces,samples,n_channels,dtype=np.float64):
+	shape=(len(spaces['L']),len(spaces['V']),len(spaces['H']),samples+3,n_channels)
+	final_data=np.lib.format.open_memmap(file_name,mode='w+',dtype=dtype,shape=shape)
+	for plane in final_data: #fill plane by plane to keep memory flat
+		plane[...]=np.nan
+	final_data.flush()
+	return final_data
+
+# Per-axis backlash in steps, kept as JSON in the cache dir
+# Moves in the negative direction are commanded backlash steps further, so the stage
+# ends where a move in the positive direction would have put it
+class BacklashModel():
+	def __init__(self,file_name=None):
+		self.file_name=file_name
+		self.steps={}
+		if file_name is not None and os.path.isfile(file_name):
+			with open(file_name) as f:
+				self.steps=json.load(f)
+				
+	def save(self):
+		with open(self.file_name,'w') as f:
+			json.dump(self.steps,f,indent=1)
+			
+	def correct(self,axis,position,direction):
+		if direction<0:
+			return int(round(position-self.steps.get(axis,0)))
+		return position
+		
+	# Scans a line along axis in both directions and stores the shift between the profiles
+	def calibrate(self,m,osc,axis,positions,udist,channel=1,averages=10,event_stop=None):
+		positions=sorted(positions)
+		forward=measure_line_profile(m,osc,axis,positions,udist,channel,averages,event_stop)
+		reverse=measure_line_profile(m,osc,axis,positions[::-1],udist,channel,averages,event_stop)[::-1]
+		step=positions[1]-positions[0]
+		self.steps[axis]=float(estimate_shift(forward,reverse)*step)
+		print('Backlash of {}: {:.1f} steps'.format(axis,self.steps[axis]))
+		return self.steps[axis]
+
+# Amplitude at each position, moving in the order given. The first point is approached
+# from lead_in steps before it so that the play is already taken up.
+def measure_line_profile(m,osc,axis,positions,udist,channel=1,averages=10,event_stop=None,lead_in=50):
+	scan=RasterScan(m,osc,[channel],averages,event_stop or threading.Event(),pipelined=False)
+	direction=np.sign(positions[-1]-positions[0])
+	m.move(m.devices[axis],int(positions[0]-direction*lead_in),udist[axis])
+	profile=np.zeros(len(positions))
+	for i,position in enumerate(positions):
+		m.move(m.devices[axis],int(position),udist[axis])
+		data=scan.acquire()()
+		profile[i]=get_amplitude(np.mean(data[channel],axis=0))
+	return profile
+
+# Shift in samples that best maps reverse onto forward, reverse[i]=forward[i+shift]
+# Correlates the derivatives since the edges carry the position, peak refined by a parabola
+def estimate_shift(forward,reverse):
+	f=np.gradient(np.asarray(forward,dtype=float))
+	r=np.gradient(np.asarray(reverse,dtype=float))
+	c=np.correlate(f-np.mean(f),r-np.mean(r),mode='full')
+	k=int(np.argmax(c))
+	shift=float(k-(len(r)-1))
+	if 0<k<len(c)-1:
+		y0,y1,y2=c[k-1:k+2]
+		if y0-2*y1+y2!=0:
+			shift+=0.5*(y0-y2)/(y0-2*y1+y2)
+	return shift
+
+class RasterScan():
+	def __init__(self,m,osc,channels,averages,event_stop,pipelined=True,on_pixel=None,plot_channel=1,timer=None,
+			serpentine=False,backlash=None):
+		self.m=m
+		self.osc=osc
+		self.channels=channels
+		self.averages=averages
+		self.event_stop=event_stop
+		self.pipelined=pipelined
+		self.on_pixel=on_pixel #called with (img_data,l) after every pixel
+		self.plot_channel=plot_channel
+		self.timer=timer if timer is not None else StageTimer() #per-stage breakdown of the scan time
+		self.serpentine=serpentine
+		self.backlash=backlash #BacklashModel applied to moves in the negative direction
+		self.last_position={} #last nominal position and direction of each axis
+		self.direction={}
+		self.sampled=None #(V,H) mask of the pixels measured in the current plane, run_adaptive only
+		
+	# Yields the stage moves needed before each pixel, (axis,position,pause) each, the pixel
+	# indices and position and whether the pixel ends a row. The last item only carries the
+	# return moves. Serpentine scans reverse every other row and plane and never return.
+	def plan(self,spaces,h_return,v_return):
+		moves=[]
+		row=0
+		for li,l in enumerate(spaces['L']):
+			moves.append(('L',l,0))
+			v_order=list(enumerate(spaces['V']))
+			if self.serpentine and li%2:
+				v_order.reverse()
+			for vi,v in v_order:
+				moves.append(('V',v,0))
+				h_order=list(enumerate(spaces['H']))
+				if self.serpentine and row%2:
+					h_order.reverse()
+				row+=1
+				for n,(hi,h) in enumerate(h_order):
+					moves.append(('H',h,0))
+					yield moves,(li,vi,hi),(h,v,l),n==len(h_order)-1
+					moves=[]
+				if h_return is not None and not self.serpentine: # return slowly to beginning position
+					moves+=[('H',int(h_r),0.1) for h_r in h_return]
+			if v_return is not None and not self.serpentine: # return slowly to beginning position
+				moves+=[('V',int(v_r),0.1) for v_r in v_return]
+		yield moves,None,None,True
+		
+	def execute_moves(self,moves,udist):
+		for axis,position,pause in moves:
+			direction=np.sign(position-self.last_position.get(axis,position))
+			if direction!=0:
+				self.direction[axis]=direction
+			self.last_position[axis]=position
+			target=position
+			if self.backlash is not None:
+				target=self.backlash.correct(axis,position,self.direction.get(axis,1))
+			with self.timer.stage('move' if not pause else 'return'):
+				self.m.move(self.m.devices[axis],target,udist[axis])
+				if pause:
+					time.sleep(pause)
+				
+	# Triggers the scope for one pixel and returns a function doing the readout
+	# Segmented scopes keep all averages in memory so the readout can be deferred
+	def acquire(self):
+		if self.event_stop.is_set():
+			raise Exception('Killing scan...')
+		osc=self.osc
+		if hasattr(osc,'arm_segments'): #all averages in one segmented acquisition
+			osc.arm_segments(self.averages)
+			def readout():
+				data={}
+				for c in self.channels:
+					data[c]=osc.read_segments(channel=c)
+				osc.end_segments()
+				return data
+			return readout
+		data=defaultdict(list)
+		for _ in range(self.averages):
+			while True:
+				try:
+					if self.event_stop.is_set():
+						raise Exception('Killing scan...')
+					osc.take_data()
+					for c in self.channels:
+						res,clipped=osc.read_waveform(channel=c)
+						data[c].append(np.array(res))
+				except IndexError:
+					continue
+				break
+		return lambda: data
+		
+	def process(self,readout,scope_free,index,position,row_end,final_data,img_data):
+		try:
+			with self.timer.stage('waveform transfer'):
+				data=readout()
+		finally:
+			scope_free.set()
+		li,vi,hi=index
+		samples=final_data.shape[3]-3
+		for ci,c in enumerate(self.channels):
+			average=np.mean(data[c],axis=0)
+			if c==self.plot_channel:
+				img_data[vi,hi]=get_amplitude(average)
+				if self.on_pixel is not None:
+					with self.timer.stage('plotting'):
+						self.on_pixel(img_data,position[2])
+			final_data[li,vi,hi,:samples,ci]=average
+			final_data[li,vi,hi,samples:,ci]=position
+		if row_end:
+			with self.timer.stage('disk write'):
+				final_data.flush() #completed rows are on disk if the scan crashes
+		self.timer.point_done()
+			
+	def run(self,spaces,h_return,v_return,final_data,udist):
+		img_data=np.zeros((len(spaces['V']),len(spaces['H'])))
+		self.start_positions(spaces)
+		self.scan(self.plan(spaces,h_return,v_return),final_data,img_data,udist)
+		final_data.flush()
+		return img_data
+		
+	def start_positions(self,spaces):
+		for axis in spaces: #directions of the first moves are known
+			self.last_position[axis]=self.m.get_position(self.m.devices[axis])[0]
+			
+	# Moves, acquires and processes the pixels of a plan, returns when all are processed
+	def scan(self,plan,final_data,img_data,udist):
+		with ThreadPoolExecutor(max_workers=1) as worker:
+			pending=None
+			scope_free=None
+			for moves,index,position,row_end in plan:
+				if index is not None:
+					tracer.mark_point() #instrument calls per pixel, if traced
+				self.execute_moves(moves,udist) # overlaps with the readout of the previous pixel
+				if index is None:
+					break
+				if scope_free is not None:
+					scope_free.wait()
+				if pending is not None and pending.done():
+					pending.result() # raises errors of the worker
+				with self.timer.stage('acquisition'):
+					readout=self.acquire()
+				scope_free=threading.Event()
+				pending=worker.submit(self.process,readout,scope_free,index,position,row_end,final_data,img_data)
+				if not self.pipelined:
+					pending.result()
+			if pending is not None:
+				pending.result()
+				
+	# Plan for a set of (vi,hi) pixels of plane li, row by row with alternating H direction
+	def plan_points(self,spaces,li,points):
+		rows=defaultdict(list)
+		for vi,hi in points:
+			rows[vi].append(hi)
+		moves=[('L',spaces['L'][li],0)]
+		ordered=[]
+		for n,vi in enumerate(sorted(rows)):
+			ordered+=[(vi,hi) for hi in sorted(rows[vi],reverse=n%2==1)]
+		v_last=None
+		for n,(vi,hi) in enumerate(ordered):
+			if vi!=v_last:
+				moves.append(('V',spaces['V'][vi],0))
+				v_last=vi
+			moves.append(('H',spaces['H'][hi],0))
+			position=(spaces['H'][hi],spaces['V'][vi],spaces['L'][li])
+			yield moves,(li,vi,hi),position,n==len(ordered)-1 #flushed after every pass
+			moves=[]
+			
+	# Adaptive quadtree scan of every L plane. A coarse raster every coarse pixels is refined
+	# where the amplitude range over the corners of a cell exceeds threshold times the range
+	# of the whole plane, halving the cell down to single pixels. Each refinement pass is
+	# one serpentine plan. Pixels never visited are bilinearly interpolated from the corners
+	# of their cell in img_data, their waveforms in final_data stay NaN. The interpolated map
+	# of each plane is passed to on_pixel once more, all planes are returned as (L,V,H).
+	# The coarse step has to be smaller than the features looked for, or they may be missed.
+	def run_adaptive(self,spaces,final_data,udist,coarse=8,threshold=0.2):
+		nv,nh=len(spaces['V']),len(spaces['H'])
+		maps=np.full((len(spaces['L']),nv,nh),np.nan)
+		self.start_positions(spaces)
+		for li in range(len(spaces['L'])):
+			img_data=maps[li] #own array per plane, a pending live map frame is not overwritten
+			self.sampled=np.zeros((nv,nh),dtype=bool)
+			vs=list(range(0,nv-1,coarse))+[nv-1]
+			hs=list(range(0,nh-1,coarse))+[nh-1]
+			cells=[(v0,h0,v1,h1) for v0,v1 in lattice_pairs(vs) for h0,h1 in lattice_pairs(hs)]
+			todo={(v,h) for v in vs for h in hs}
+			leaves=[]
+			while todo:
+				self.scan(self.plan_points(spaces,li,todo),final_data,img_data,udist)
+				for v,h in todo:
+					self.sampled[v,h]=True
+				span=np.nanmax(img_data)-np.nanmin(img_data)
+				todo=set()
+				refined=[]
+				for v0,h0,v1,h1 in cells:
+					corners=img_data[[v0,v0,v1,v1],[h0,h1,h0,h1]]
+					if (v1-v0<=1 and h1-h0<=1) or not np.ptp(corners)>threshold*span:
+						leaves.append((v0,h0,v1,h1))
+						continue
+					v_cuts=[v0,(v0+v1)//2,v1] if v1-v0>1 else [v0,v1]
+					h_cuts=[h0,(h0+h1)//2,h1] if h1-h0>1 else [h0,h1]
+					for a,b in zip(v_cuts[:-1],v_cuts[1:]):
+						for c,d in zip(h_cuts[:-1],h_cuts[1:]):
+							refined.append((a,c,b,d))
+							todo.update(p for p in [(a,c),(a,d),(b,c),(b,d)] if not self.sampled[p])
+				cells=refined
+			for v0,h0,v1,h1 in leaves:
+				interpolate_cell(img_data,self.sampled,v0,h0,v1,h1)
+			if self.on_pixel is not None:
+				with self.timer.stage('plotting'):
+					self.on_pixel(img_data,spaces['L'][li])
+			final_data.flush()
+			print('Plane {}: {} of {} pixels sampled'.format(li,int(self.sampled.sum()),nv*nh))
+		return maps
+		
+# Consecutive lattice indices, a single index gives a degenerate pair (single line scans)
+def lattice_pairs(indices):
+	return list(zip(indices[:-1],indices[1:])) or [(indices[0],indices[0])]
+	
+# Bilinear fill of the pixels of a cell that were not sampled, from its four corners
+def interpolate_cell(img_data,sampled,v0,h0,v1,h1):
+	v=np.arange(v0,v1+1)[:,None]
+	h=np.arange(h0,h1+1)[None,:]
+	ty=(v-v0)/max(v1-v0,1)
+	tx=(h-h0)/max(h1-h0,1)
+	c00,c01,c10,c11=img_data[[v0,v0,v1,v1],[h0,h1,h0,h1]]
+	fill=(1-ty)*(1-tx)*c00+(1-ty)*tx*c01+ty*(1-tx)*c10+ty*tx*c11
+	block=img_data[v0:v1+1,h0:h1+1]
+	missing=~sampled[v0:v1+1,h0:h1+1]
+	block[missing]=fill[missing]
@@ -0,0 +1,171 @@
+import os,re,glob,time,argparse
+from concurrent.futures import ProcessPoolExecutor
+
+### Offline reanalysis of voltage scan runs
+### Finds the run directories written by execute_TCT_scan_voltage.py (<name>_<timestamp> with
+### wf_*.csv files of older runs or the wf_<name>.h5 WaveformStore), extracts the pulse features
+### of every saved waveform in a process pool and writes per run
+###   <name>_reanalysis.csv         voltage, events, mean and std of every feature per point
+###   <name>_reanalysis_<x>.png     grid plots as saved by the scan
+### The mean current of the summary <name>.csv is added for the points it covers.
+###
+### Parsed CSV waveforms are cached as .npy in <run>/wf_cache and reused while newer than the
+### CSV, a second pass only reads the cache. The HDF5 store is binary already and read directly.
+###
+### python reanalyze_scan.py C:/LGAD_data/voltage_scan_data
+### python reanalyze_scan.py run_dir_1 run_dir_2 --fractions 0.1 0.2 0.5 --workers 8
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+from pulse_features import extract_features, summarize
+from scan_summary import summary_columns, plot_voltage_grid
+from waveform_store import WaveformStoreReader
+
+run_pattern = re.compile(r'^(?P<name>.+)_(?P<timestamp>\d{8}-\d{6})$')
+csv_pattern = re.compile(r'^wf_.+_(?P<voltage>\d+(\.\d+)?)V\.csv$')
+
+# (feature, statistic, file suffix, axis label) of the grid plots
+grid_plots = [('amplitude', 'mean', 'amp', 'Amplitude [V]'),
+              ('rise_time', 'mean', 'rise', 'Rise time [s]'),
+              ('slew_rate', 'mean', 'slew', 'Slew rate [V/s]'),
+              ('charge', 'mean', 'charge', 'Charge [C]'),
+              ('noise', 'mean', 'noise', 'Noise [V]')]
+
+## Run directories below the given paths, as (path, name, timestamp)
+def find_runs(paths):
+    runs = []
+    for root in paths:
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names[:] = [d for d in dir_names if d != 'wf_cache']
+            match = run_pattern.match(os.path.basename(os.path.normpath(dir_path)))
+            if match and any(f.startswith('wf_') and f.endswith(('.csv', '.h5')) for f in file_names):
+                runs.append((dir_path, match.group('name'), match.group('timestamp')))
+    return sorted(runs, key=lambda r: (r[2], r[0]))
+
+## (voltage, source) of every saved point of a run, source is (file, index) for the HDF5 store
+## Older runs name the CSV files by the absolute bias, the scan biases are negative
+def run_points(run_dir):
+    points = []
+    for file_name in glob.glob(os.path.join(run_dir, 'wf_*.h5')):
+        with WaveformStoreReader(file_name) as reader:
+            points += [(float(v), (file_name, i)) for i, v in enumerate(reader.voltages)]
+    for file_name in glob.glob(os.path.join(run_dir, 'wf_*.csv')):
+        match = csv_pattern.match(os.path.basename(file_name))
+        if match:
+            points.append((-float(match.group('voltage')), (file_name, None)))
+    return sorted(points, key=lambda p: -p[0])
+
+def cache_file(file_name):
+    run_dir, base = os.path.split(file_name)
+    return os.path.join(run_dir, 'wf_cache', os.path.splitext(base)[0]+'.npy')
+
+## Time axis and (N, samples) waveforms of one point
+def load_point(source, use_cache=True):
+    file_name, index = source
+    if index is not None:
+        with WaveformStoreReader(file_name) as reader:
+            return reader.timebase.axis, reader[index].T
+    cached = cache_file(file_name)
+    if use_cache and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(file_name):
+        data = np.load(cached)
+    else:
+        data = np.loadtxt(file_name, delimiter=',', ndmin=2)    # Time axis, then one waveform per column
+        if use_cache:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            np.save(cached, data)
+    return data[:, 0], data[:, 1:].T
+
+## Worker: features of one point, options are the keyword arguments of extract_features
+def analyze_point(task):
+    voltage, source, use_cache, options = task
+    time_axis, waveforms = load_point(source, use_cache)
+    return voltage, extract_features(waveforms, time_axis, **options)
+
+## Mean current of the summary CSV at every voltage, matched on the operating voltage
+def summary_current(run_dir, name, voltages):
+    current = np.full(len(voltages), np.nan)
+    file_name = os.path.join(run_dir, name+'.csv')
+    if not os.path.exists(file_name):
+        return current
+    summary = np.loadtxt(file_name, delimiter=',', ndmin=2)
+    summary = summary[np.isfinite(summary[:, 0])]
+    if len(summary) == 0:
+        return current
+    for i, voltage in enumerate(voltages):
+        nearest = np.argmin(np.abs(summary[:, 0]-voltage))
+        if abs(summary[nearest, 0]-voltage) < 0.5:
+            current[i] = summary[nearest, summary_columns.index('mean_current')]
+    return current
+
+def write_results(output_dir, name, voltages, features, current, plots=True):
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = [summarize(f) for f in features]
+    names = features[0].dtype.names
+    columns = [np.array(voltages), np.array([len(f) for f in features]), current]
+    header = ['voltage', 'events', 'current']
+    for feature in names:
+        for statistic in ('mean', 'std'):
+            columns.append(np.array([s[feature][statistic] for s in summaries]))
+            header.append(feature+'_'+statistic)
+    table = np.column_stack(columns)
+    np.savetxt(os.path.join(output_dir, name+'_reanalysis.csv'), table, delimiter=',',
+        header=','.join(header), comments='')
+    if plots:
+        volt_array = table[:, 0]
+        jitter = [(f, 'std', 'jitter_'+f[4:], 'Jitter {} % CFD [s]'.format(f[4:]))
+                  for f in names if f.startswith('cfd_')]
+        for feature, statistic, suffix, label in jitter+grid_plots:
+            plot_voltage_grid(volt_array, table[:, header.index(feature+'_'+statistic)],
+                os.path.join(output_dir, '{}_reanalysis_{}.png'.format(name, suffix)), label)
+    return table
+
+def reanalyze(paths, output=None, workers=None, use_cache=True, plots=True, **options):
+    runs = find_runs(paths)
+    tasks = []
+    owners = []                                     # Run of every task
+    for run_index, (run_dir, name, timestamp) in enumerate(runs):
+        for voltage, source in run_points(run_dir):
+            tasks.append((voltage, source, use_cache, options))
+            owners.append(run_index)
+    print('{} runs, {} points'.format(len(runs), len(tasks)))
+    start_time = time.time()
+    chunksize = max(1, len(tasks)//(4*(workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(analyze_point, tasks, chunksize=chunksize))
+    print('Features extracted in {:.1f} s'.format(time.time()-start_time))
+
+    tables = {}
+    for run_index, (run_dir, name, timestamp) in enumerate(runs):
+        points = [result for result, owner in zip(results, owners) if owner == run_index]
+        if not points:
+            continue
+        voltages = [p[0] for p in points]
+        output_dir = run_dir
+        if output is not None:
+            output_dir = os.path.join(output, os.path.basename(os.path.normpath(run_dir)))
+        tables[run_dir] = write_results(output_dir, name, voltages, [p[1] for p in points],
+            summary_current(run_dir, name, voltages), plots=plots)
+        print('{}: {} points'.format(run_dir, len(points)))
+    return tables
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pulse feature reanalysis of voltage scan runs')
+    parser.add_argument('paths', nargs='+', help='Run directories or directories containing runs')
+    parser.add_argument('--output', default=None, help='Results directory, default the run directories')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, default the CPU count')
+    parser.add_argument('--no-cache', action='store_true', help='Parse the CSV files without the .npy cache')
+    parser.add_argument('--no-plots', action='store_true')
+    parser.add_argument('--fractions', type=float, nargs='+', default=[0.2, 0.5], help='CFD fractions')
+    parser.add_argument('--polarity', choices=['auto', 'positive', 'negative'], default='auto')
+    parser.add_argument('--baseline-samples', type=int, default=100)
+    parser.add_argument('--threshold', type=float, default=None, help='Slew rate threshold in V, default 50 %%')
+    args = parser.parse_args(argv)
+    polarity = {'auto': 'auto', 'positive': 1, 'negative': -1}[args.polarity]
+    return reanalyze(args.paths, output=args.output, workers=args.workers, use_cache=not args.no_cache,
+        plots=not args.no_plots, fractions=tuple(args.fractions), polarity=polarity,
+        baseline_samples=args.baseline_samples, threshold=args.threshold)
+
+if __name__ == '__main__':
+    main()
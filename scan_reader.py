@@ -0,0 +1,174 @@
+import os
+import re
+import glob
+import numpy as np
+
+### Position-indexed reader of the TwoDScan output files
+### Two formats are read, both as rows of (samples+3, channels) with (h,v,l) in the last 3 samples:
+###   <prefix>_1000points_position_last_3_<N>.npy   chunks of up to 1000 points written by the older
+###       scan loop. Each point was prepended with vstack, so the rows of a chunk run backwards in time.
+###   <prefix>_scan_loop_<N>.npy                    one (L,V,H,samples+3,channels) file per scan loop,
+###       see raster_scan.open_scan_file. Points not scanned are NaN and left out of the index.
+### The index (h,v,l -> file, row) is built once and saved to <prefix>_position_index.npz. It is rebuilt
+### when files are added or change. Files are opened with mmap_mode='r', so a lookup only reads the
+### rows it returns. A position scanned more than once (scan loops, repeated chunks) keeps one entry
+### per file in file order, lookups return the last one unless another occurrence is asked for.
+###
+### reader=ScanReader(data_dir,prefix)
+### reader.point(h,v,l)            (samples,channels)
+### reader.line('H',v=v,l=l)       h positions, (H,samples,channels)
+### reader.plane(l=l)              h and v positions, (V,H,samples,channels), NaN where not scanned
+
+chunk_pattern=re.compile(r'_1000points_position_last_3_(\d+)\.npy$')
+loop_pattern=re.compile(r'_scan_loop_(\d+)\.npy$')
+index_dtype=np.dtype([('h',np.int64),('v',np.int64),('l',np.int64),('file',np.int32),('row',np.int64),('order',np.int64)])
+axes=('h','v','l')
+
+# Scan files of the prefix in acquisition order, chunks first as the older format
+def scan_files(data_dir,prefix):
+	files=[]
+	for pattern in (chunk_pattern,loop_pattern):
+		found=[]
+		for file_name in glob.glob(os.path.join(glob.escape(data_dir),glob.escape(prefix)+'_*.npy')):
+			match=pattern.search(os.path.basename(file_name))
+			if match and os.path.basename(file_name)[:match.start()]==prefix: #not a longer prefix
+				found.append((int(match.group(1)),file_name))
+		files+=[f for _,f in sorted(found)]
+	return files
+
+# Rows of (samples+3, channels) of a scan file, memory-mapped
+def open_rows(file_name):
+	data=np.load(file_name,mmap_mode='r')
+	if data.ndim==5: #(L,V,H,samples+3,channels)
+		data=data.reshape((-1,)+data.shape[3:])
+	return data
+
+# (h,v,l) of every row, rows of the older chunks reversed into acquisition order
+def file_positions(file_name):
+	rows=open_rows(file_name)
+	positions=np.array(rows[:,-3:,0])
+	row=np.arange(len(rows))
+	if chunk_pattern.search(file_name):
+		positions=positions[::-1]
+		row=row[::-1]
+	valid=np.all(np.isfinite(positions),axis=1)
+	return np.rint(positions[valid]).astype(np.int64),row[valid]
+
+def file_stamps(files):
+	return np.array([(os.path.getsize(f),os.path.getmtime(f)) for f in files],dtype=float).reshape(-1,2)
+
+class ScanReader():
+	def __init__(self,data_dir,prefix,rebuild=False):
+		self.data_dir=data_dir
+		self.prefix=prefix
+		self.index_file=os.path.join(data_dir,prefix+'_position_index.npz')
+		self.files=scan_files(data_dir,prefix)
+		if not self.files:
+			raise FileNotFoundError('No scan files of {} in {}'.format(prefix,data_dir))
+		self.index=None if rebuild else self.load_index()
+		if self.index is None:
+			self.index=self.build_index()
+		self.rows={} #open memmaps by file
+		self.lookup={}
+		for i,(h,v,l) in enumerate(zip(self.index['h'],self.index['v'],self.index['l'])):
+			self.lookup.setdefault((int(h),int(v),int(l)),[]).append(i) #index is in file order
+
+	def __len__(self):
+		return len(self.index)
+
+	# Saved index, None if missing or the files changed since
+	def load_index(self):
+		if not os.path.exists(self.index_file):
+			return None
+		with np.load(self.index_file) as saved:
+			names=[str(n) for n in saved['files']]
+			if names!=[os.path.basename(f) for f in self.files]:
+				return None
+			if not np.array_equal(saved['stamps'],file_stamps(self.files)):
+				return None
+			return saved['index']
+
+	def build_index(self):
+		parts=[]
+		order=0
+		for file_index,file_name in enumerate(self.files):
+			positions,row=file_positions(file_name)
+			part=np.empty(len(row),dtype=index_dtype)
+			part['h'],part['v'],part['l']=positions.T
+			part['file']=file_index
+			part['row']=row
+			part['order']=order+np.arange(len(row))
+			order+=len(row)
+			parts.append(part)
+		index=np.concatenate(parts) if parts else np.empty(0,dtype=index_dtype)
+		np.savez(self.index_file,index=index,files=np.array([os.path.basename(f) for f in self.files]),
+			stamps=file_stamps(self.files))
+		return index
+
+	def file_rows(self,file_index):
+		if file_index not in self.rows:
+			self.rows[file_index]=open_rows(self.files[file_index])
+		return self.rows[file_index]
+
+	# Unique scanned values of one axis ('h', 'v' or 'l'), sorted
+	def positions(self,axis):
+		return np.unique(self.index[axis.lower()])
+
+	# Index entry of a position, None if not scanned
+	def entry(self,h,v,l,occurrence=-1):
+		entries=self.lookup.get((int(h),int(v),int(l)))
+		if entries is None:
+			return None
+		return self.index[entries[occurrence]]
+
+	# Waveforms of the given index entries as (n,samples,channels), rows read file by file
+	def read(self,entries):
+		rows=self.file_rows(int(entries['file'][0]) if len(entries) else 0)
+		out=np.empty((len(entries),rows.shape[1]-3,rows.shape[2]),dtype=rows.dtype)
+		for file_index in np.unique(entries['file']):
+			selected,=np.where(entries['file']==file_index)
+			rows=self.file_rows(int(file_index))
+			order=np.argsort(entries['row'][selected]) #ascending rows for the memmap
+			out[selected[order]]=rows[np.sort(entries['row'][selected]),:-3,:]
+		return out
+
+	def point(self,h,v,l,occurrence=-1):
+		entry=self.entry(h,v,l,occurrence)
+		if entry is None:
+			raise KeyError('Position h={} v={} l={} not in {}'.format(h,v,l,self.prefix))
+		return np.array(self.file_rows(int(entry['file']))[int(entry['row']),:-3,:])
+
+	# All points along axis at the fixed other two coordinates, sorted along the axis
+	def line(self,axis,occurrence=-1,**fixed):
+		axis=axis.lower()
+		others=[a for a in axes if a!=axis]
+		mask=np.ones(len(self.index),dtype=bool)
+		for a in others:
+			mask&=self.index[a]==int(fixed[a])
+		values=np.unique(self.index[axis][mask])
+		position=dict(fixed)
+		entries=[]
+		for value in values:
+			position[axis]=value
+			entries.append(self.entry(position['h'],position['v'],position['l'],occurrence))
+		return values,self.read(np.array(entries,dtype=index_dtype))
+
+	# (V,H,samples,channels) plane at one L, NaN at positions not scanned
+	def plane(self,l,occurrence=-1):
+		mask=self.index['l']==int(l)
+		hs=np.unique(self.index['h'][mask])
+		vs=np.unique(self.index['v'][mask])
+		entries=[]
+		cells=[]
+		for vi,v in enumerate(vs):
+			for hi,h in enumerate(hs):
+				entry=self.entry(h,v,l,occurrence)
+				if entry is not None:
+					entries.append(entry)
+					cells.append((vi,hi))
+		data=self.read(np.array(entries,dtype=index_dtype))
+		out=np.full((len(vs),len(hs))+data.shape[1:],np.nan,dtype=np.result_type(data.dtype,np.float32))
+		if cells:
+			vi,hi=np.array(cells).T
+			out[vi,hi]=data
+		return hs,vs,out
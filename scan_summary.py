@@ -0,0 +1,19 @@
+import matplotlib.pyplot as plt
+
+### Summary of a voltage scan, without the instrument drivers so offline tools can import it
+### summary_columns is the layout of the <name>.csv rows built by cmd_lib.scan_voltage_point.
+### Scope statistics come from the pre-set measurement groups: 1 delay trig 50% - signal 50%,
+### 2 slew 49%-51% range, 3 amplitude, 4 area to 0 V level, 5 low.
+summary_columns = ['op_volt',
+                   'mean_delay',   'std_delay',   'mean_slew',   'std_slew',
+                   'mean_amp',     'std_amp',     'mean_area',   'std_area',
+                   'mean_low',     'std_low',     'count',
+                   'mean_current', 'std_current', 'current_meas_size']
+
+def plot_voltage_grid(volt_array, grid, file_name, label=''):
+    plt.subplot()
+    plt.plot(-volt_array, grid)
+    plt.xlabel('Bias voltage [V]')
+    plt.ylabel(label)
+    plt.savefig(file_name, bbox_inches='tight')
+    plt.clf()
@@ -0,0 +1,26 @@
+import numpy as np
+
+### Time axis of a scope record, built from the record length and X increment/origin
+### so that it always has exactly one entry per sample. Drivers cache one instance
+### and drop it whenever the horizontal settings change.
+class Timebase():
+
+    def __init__(self, points, x_increment, x_origin):
+        self.points = int(points)
+        self.x_increment = float(x_increment)
+        self.x_origin = float(x_origin)
+        self._axis = None
+
+    def __len__(self):
+        return self.points
+
+    def __repr__(self):
+        return 'Timebase(points={}, x_increment={}, x_origin={})'.format(
+            self.points, self.x_increment, self.x_origin)
+
+    @property
+    def axis(self):
+        if self._axis is None:
+            self._axis = self.x_origin + self.x_increment*np.arange(self.points)
+            self._axis.flags.writeable = False      # Shared between callers
+        return self._axis
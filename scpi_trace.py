@@ -0,0 +1,174 @@
+import os
+import time
+import json
+import re
+import threading
+from collections import deque
+import numpy as np
+
+### Opt-in tracing of the instrument sessions
+### The drivers wrap their device session with traced(), which returns the session itself
+### unless tracing is enabled with TCT_TRACE=1 or trace=True in the driver constructor.
+### A TracedSession records every transaction as (time, instrument, command, direction,
+### bytes, latency, point) in one ring buffer shared by all instruments (TCT_TRACE_SIZE
+### records, default 100000). Recording is one tuple per call, commands are only parsed
+### when the histograms are exported, so tracing can stay on during real scans.
+### The scan loops call tracer.mark_point() before each point to count calls per point.
+
+### SCPI header to short form, e.g. ':CHANNEL2:SCALE' -> 'CHAN2:SCAL'
+def short_node(node):
+    m = re.match(r'([A-Z*]+)(\d*)(\??)$', node)
+    if not m:
+        return node
+    letters, digits, query = m.groups()
+    if len(letters) > 4:
+        letters = letters[:3] if letters[3] in 'AEIOU' else letters[:4]
+    return letters+digits+query
+
+def normalise(command):
+    command = command.strip()
+    header, _, args = command.partition(' ')
+    nodes = header.upper().lstrip(':').split(':')
+    return ':'.join(short_node(n) for n in nodes), args.strip()
+
+def tracing_enabled(trace=None):
+    if trace is not None:
+        return trace
+    return os.environ.get('TCT_TRACE', '0').lower() in ('1', 'true', 'yes', 'on')
+
+## Histogram key of a command, e.g. ':CHANNEL2:SCALE 0.1;:MEAS1:RES:AVG?' -> 'CHAN2:SCAL;MEAS1:RES:AVG?'
+def command_key(command):
+    if isinstance(command, bytes):
+        command = command.decode(errors='replace')
+    parts = [p for p in command.strip().split(';') if p.strip()]
+    return ';'.join(normalise(p.split('=')[0])[0] for p in parts)
+
+# Latency histogram bin edges in s, log spaced from 10 us to 100 s
+latency_bins = np.logspace(-5, 2, 29)
+
+class Tracer():
+
+    def __init__(self, size=None):
+        if size is None:
+            size = int(os.environ.get('TCT_TRACE_SIZE', '100000'))
+        self.records = deque(maxlen=size)
+        self.point = 0
+        self.lock = threading.Lock()
+
+    def record(self, instrument, command, direction, nbytes, latency):
+        with self.lock:
+            self.records.append((time.time(), instrument, command, direction, nbytes, latency, self.point))
+
+    def mark_point(self):
+        self.point += 1
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.point = 0
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.records)
+
+    ## Per (instrument, command) statistics and latency histogram over latency_bins
+    def histograms(self):
+        groups = {}
+        for _, instrument, command, direction, nbytes, latency, _ in self.snapshot():
+            key = (instrument, command_key(command), direction)
+            group = groups.setdefault(key, ([], []))
+            group[0].append(latency)
+            group[1].append(nbytes)
+        result = []
+        for (instrument, command, direction), (latencies, nbytes) in groups.items():
+            latencies = np.array(latencies)
+            counts, _ = np.histogram(latencies, bins=latency_bins)
+            result.append({'instrument': instrument, 'command': command, 'direction': direction,
+                           'calls': len(latencies), 'bytes': int(np.sum(nbytes)),
+                           'total': float(np.sum(latencies)), 'mean': float(np.mean(latencies)),
+                           'p50': float(np.percentile(latencies, 50)),
+                           'p95': float(np.percentile(latencies, 95)),
+                           'max': float(np.max(latencies)), 'histogram': counts.tolist()})
+        result.sort(key=lambda x: -x['total'])
+        return result
+
+    ## Calls and time per scan point and instrument, point 0 is everything before the first mark
+    def calls_per_point(self):
+        points = {}
+        for _, instrument, _, _, _, latency, point in self.snapshot():
+            entry = points.setdefault(point, {}).setdefault(instrument, [0, 0.0])
+            entry[0] += 1
+            entry[1] += latency
+        return {point: {instrument: {'calls': calls, 'time': seconds}
+                        for instrument, (calls, seconds) in instruments.items()}
+                for point, instruments in sorted(points.items())}
+
+    def report(self, top=20):
+        lines = ['{:<10} {:<34} {:<6} {:>7} {:>9} {:>9} {:>9}'.format(
+            'instrument', 'command', 'dir', 'calls', 'total s', 'mean ms', 'p95 ms')]
+        for h in self.histograms()[:top]:
+            lines.append('{:<10} {:<34} {:<6} {:>7} {:>9.3f} {:>9.2f} {:>9.2f}'.format(
+                h['instrument'], h['command'][:34], h['direction'], h['calls'], h['total'],
+                1e3*h['mean'], 1e3*h['p95']))
+        per_point = [sum(i['calls'] for i in p.values())
+                     for point, p in self.calls_per_point().items() if point > 0]
+        if per_point:
+            lines.append('Calls per scan point: mean {:.1f}, min {}, max {} over {} points'.format(
+                np.mean(per_point), min(per_point), max(per_point), len(per_point)))
+        return '\n'.join(lines)
+
+    def save(self, file_name):
+        result = {'latency_bins': latency_bins.tolist(), 'commands': self.histograms(),
+                  'points': self.calls_per_point()}
+        with open(file_name, 'w') as f:
+            json.dump(result, f, indent=1)
+        return result
+
+tracer = Tracer()
+
+### Proxy around a pyvisa resource, RsInstrument session or serial port
+### Traced methods record their transaction, everything else is passed to the session
+class TracedSession():
+
+    # Method name -> direction. Bytes are the command (first argument) plus the reply
+    traced_methods = {
+        'write': 'write', 'write_str': 'write', 'write_with_opc': 'write', 'write_str_with_opc': 'write',
+        'query': 'query', 'query_str': 'query', 'query_with_opc': 'query', 'query_str_with_opc': 'query',
+        'query_bin_block': 'binary', 'query_ascii_values': 'query', 'query_binary_values': 'binary',
+        'read': 'read', 'read_raw': 'read', 'readline': 'read',
+        'read_file_from_instrument_to_pc': 'file'}
+
+    def __init__(self, session, instrument, tracer=tracer):
+        object.__setattr__(self, 'session', session)
+        object.__setattr__(self, 'instrument', instrument)
+        object.__setattr__(self, 'tracer', tracer)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.session, name)
+        direction = self.traced_methods.get(name)
+        if direction is None or not callable(attribute):
+            return attribute
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            reply = attribute(*args, **kwargs)
+            latency = time.perf_counter()-start
+            command = args[0] if args and direction != 'read' else name
+            nbytes = len(command) if direction in ('write', 'query', 'binary') else 0
+            if isinstance(reply, (str, bytes, bytearray)):
+                nbytes += len(reply)
+            elif hasattr(reply, 'nbytes'):
+                nbytes += reply.nbytes
+            elif isinstance(reply, (list, tuple)):
+                nbytes += 4*len(reply)
+            self.tracer.record(self.instrument, command, direction, nbytes, latency)
+            return reply
+        object.__setattr__(self, name, call)    # Found directly from now on
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self.session, name, value)
+
+def traced(session, instrument, trace=None):
+    if tracing_enabled(trace):
+        return TracedSession(session, instrument)
+    return session
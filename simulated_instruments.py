@@ -0,0 +1,816 @@
+import os
+import re
+import time
+from ctypes import Structure, c_int, c_uint, c_char, c_void_p
+import numpy as np
+
+from scpi_trace import normalise
+
+### Simulated backends for every instrument driver, for running and profiling the
+### scan pipelines without hardware. Enable with the environment variable
+### TCT_SIMULATE=1 or with simulate=True in the driver constructors.
+###
+### Each simulated session answers the same commands the driver sends to the real
+### instrument, so the driver code runs unchanged. All instruments share one
+### SimulatedBench holding the physical state (bias, laser, stage positions): the
+### pulse amplitude follows the bias and the laser spot position, the leakage current
+### rises with bias and breaks down near breakdown_voltage. Every transaction sleeps
+### according to a LatencyModel. TCT_SIM_LATENCY scales all latencies (0 disables them).
+
+def simulation_enabled(simulate=None):
+    if simulate is not None:
+        return bool(simulate)
+    return os.environ.get('TCT_SIMULATE', '0').lower() in ('1', 'true', 'yes', 'on')
+
+### Per-transaction delay: fixed cost per command plus transfer time per byte
+class LatencyModel():
+
+    def __init__(self, per_command=0.002, per_byte=1e-6, overrides=None):
+        self.per_command = per_command
+        self.per_byte = per_byte
+        self.overrides = overrides or {}    # Normalised header -> per_command
+
+    def delay(self, header='', nbytes=0):
+        scale = float(os.environ.get('TCT_SIM_LATENCY', '1'))
+        seconds = scale*(self.overrides.get(header, self.per_command) + nbytes*self.per_byte)
+        if seconds > 0:
+            time.sleep(seconds)
+
+### Latencies close to the lab setup, replaced by the benchmark to model other links
+latency_models = {
+    'rtp044':   LatencyModel(per_command=0.004, per_byte=1.2e-6),   # GPIB
+    'keithley': LatencyModel(per_command=0.005, per_byte=1e-5),     # GPIB, slow instrument
+    'qd_laser': LatencyModel(per_command=0.02, per_byte=1e-4),      # RS232 9600 baud
+    'agilent':  LatencyModel(per_command=0.002, per_byte=1e-7),     # USBTMC
+    'tti':      LatencyModel(per_command=0.0, per_byte=1e-4),       # RS232, driver sleeps itself
+    'ximc':     LatencyModel(per_command=0.001, per_byte=0),        # USB
+}
+
+units = {'G': 1e9, 'M': 1e6, 'K': 1e3, 'm': 1e-3, 'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}
+
+## '100mV', '2 ns', '-0.5' -> float in base units
+def parse_value(text):
+    m = re.match(r'\s*([-+0-9.eE]+)\s*([GMKkmunpf]?)', text)
+    value = float(m.group(1))
+    prefix = m.group(2)
+    if prefix:
+        value *= units['K' if prefix == 'k' else prefix]
+    return value
+
+### Shared physical state of the simulated setup
+class SimulatedBench():
+
+    def __init__(self):
+        self.bias = 0.0                 # V on the sensor, set by the simulated SMU
+        self.output_on = False
+        self.smu_present = False        # Without a simulated SMU the sensor sits at default_bias
+        self.default_bias = 200.0
+        self.laser_on = True
+        self.laser_bias = 9.0           # mA, scales the deposited charge
+        self.trigger_rate = 1000.0      # Hz
+        self.positions = {}             # Stage axis -> position of the laser spot in steps
+        self.backlash = {'H': 6, 'V': 4, 'L': 0}    # Steps of play, the spot lags after reversing
+        self.full_depletion = 30.0      # V
+        self.gain_voltage = 200.0       # V, e-folding of the gain
+        self.breakdown_voltage = 250.0  # V
+        self.pixel_pitch = 400          # Stage steps between pixel centres
+        self.pixel_gap = 40             # Steps of insensitive gap between pixels
+        self.edge_width = 8.0           # Steps, spot size smearing the pixel edges
+        self.focus = 0                  # L position of best focus
+        self.rng = np.random.default_rng()
+
+    def leakage(self, voltage):
+        v = abs(voltage)
+        current = 2e-9*(1+v/50)+1e-9*np.exp((v-self.breakdown_voltage)/4)
+        return -current if voltage < 0 else current
+
+    ## Pixel response in [0,1] at the laser spot, smooth boxes with gaps in H and V
+    def response(self):
+        h = self.positions.get('H', 0)
+        v = self.positions.get('V', 0)
+        l = self.positions.get('L', self.focus)
+        width = self.edge_width*(1+abs(l-self.focus)/200)
+        def axis(x):
+            d = np.abs(((x+self.pixel_pitch/2) % self.pixel_pitch)-self.pixel_pitch/2)
+            return 1/(1+np.exp((d-(self.pixel_pitch-self.pixel_gap)/2)/width))
+        return axis(h)*axis(v)
+
+    ## Pulse amplitude in V for the current bias and laser position
+    def amplitude(self):
+        if not self.laser_on or (self.smu_present and not self.output_on):
+            return 0.0
+        v = min(abs(self.bias) if self.smu_present else self.default_bias, self.breakdown_voltage)
+        depletion = np.sqrt(min(v, self.full_depletion)/self.full_depletion)
+        return 0.02*(self.laser_bias/9.0)*depletion*np.exp(v/self.gain_voltage)*self.response()
+
+    ## count pulses on the time axis t, shape (count, len(t)); polarity +1 or -1
+    def pulses(self, t, count, polarity=1, noise=1e-3):
+        amp = self.amplitude()
+        t0 = 0.5e-9+20e-12*self.rng.standard_normal((count, 1))     # Trigger jitter
+        dt = np.clip(t[None, :]-t0, 0, None)
+        shape = np.exp(-dt/400e-12)-np.exp(-dt/80e-12)
+        shape /= 0.535                                              # Peak of the shape above
+        wfs = polarity*amp*shape*(1+0.05*self.rng.standard_normal((count, 1)))
+        return wfs+noise*self.rng.standard_normal(wfs.shape)
+
+bench = SimulatedBench()
+
+### Common dispatch: commands split on ';', headers normalised, handlers looked up
+class SimulatedSession():
+    latency_name = None
+    idn = 'Simulated,Instrument,0,1.0'
+    error_queue = None              # List collecting undefined headers, if the instrument has one
+
+    def __init__(self):
+        self.handlers = {}
+        self.resource_name = 'SIM::'+self.latency_name
+
+    def latency_delay(self, header, nbytes=0):
+        latency_models[self.latency_name].delay(header, nbytes)
+
+    def handle(self, command):
+        header, args = normalise(command)
+        handler = self.handlers.get(header.rstrip('?'))
+        if handler is None:
+            handler = self.handlers.get(re.sub(r'\d+', '#', header.rstrip('?')))
+        if handler is None:
+            if self.error_queue is not None:
+                self.error_queue.append('-113,"Undefined header;{}"'.format(command.strip()))
+            return None
+        return handler(header, args)
+
+    def write(self, command):
+        self.latency_delay(normalise(command)[0], len(command))
+        for part in command.split(';'):
+            if part.strip():
+                self.handle(part)
+
+    def query(self, command):
+        replies = []
+        for part in command.split(';'):
+            if part.strip():
+                reply = self.handle(part)
+                if reply is not None:
+                    replies.append(str(reply))
+        reply = ';'.join(replies)
+        self.latency_delay(normalise(command)[0], len(command)+len(reply))
+        return reply
+
+    def close(self):
+        pass
+
+def channel_of(header):
+    return int(re.search(r'CHAN[A-Z]*(\d)', header).group(1))
+
+### Rohde & Schwarz RTP044 behind the RsInstrument session API
+class SimulatedRTP044Session(SimulatedSession):
+    latency_name = 'rtp044'
+    idn = 'Rohde&Schwarz,RTP,1320.5007k04/100000,4.70.1.0 (simulated)'
+
+    def __init__(self):
+        super().__init__()
+        self.instrument_status_checking = True
+        self.visa_timeout = 6000
+        self.opc_timeout = 3000
+        self.scale = {c: 0.05 for c in range(1, 5)}
+        self.offset = {c: 0.0 for c in range(1, 5)}
+        self.position = {c: 0.0 for c in range(1, 5)}
+        self.state = {c: c in (1, 2) for c in range(1, 5)}
+        self.timescale = 1e-9
+        self.timedelay = 3e-9
+        self.resolution = 10e-12
+        self.data_format = 'ASC,0'
+        self.segmented = False
+        self.acq_count = 1
+        self.fastexport = False
+        self.history = []               # Last acquired waveforms of the trigger channel
+        self.running_since = None
+        self.meas_events = {g: 0 for g in range(1, 9)}
+        self.meas_enabled = set()
+        self.error_queue = []
+        h = self.handlers
+        h['*IDN'] = lambda hd, a: self.idn
+        h['*OPC'] = lambda hd, a: '1'
+        h['*RST'] = lambda hd, a: None
+        h['SYST:ERR'] = self.next_error
+        h['SYST:ERR:COUN'] = lambda hd, a: str(len(self.error_queue))
+        h['SYST:ERR:ALL'] = self.all_errors
+        h['CHAN#:SCAL'] = self.channel_value(self.scale)
+        h['CHAN#:OFFS'] = self.channel_value(self.offset)
+        h['CHAN#:POS'] = self.channel_value(self.position)
+        h['CHAN#:RANG'] = self.channel_range
+        h['CHAN#:STAT'] = self.channel_state
+        h['CHAN#'] = self.channel_state
+        h['CHAN#:DIGF:CUT'] = lambda hd, a: None
+        h['CHAN#:DIGF:STAT'] = lambda hd, a: None
+        h['CHAN#:HIST:STAT'] = lambda hd, a: None
+        h['CHAN#:DATA:HEAD'] = self.data_header
+        h['CHAN#:WAV:DATA'] = self.waveform_data
+        h['CHAN#:WAV#:DATA'] = self.waveform_data
+        h['CHAN#:WAV:DATA:VAL'] = self.waveform_data
+        h['CHAN#:DATA'] = self.waveform_data
+        h['TIM:SCAL'] = self.scalar('timescale')
+        h['TIM:HOR:POS'] = self.scalar('timedelay')
+        h['ACQ:RES'] = self.scalar('resolution')
+        h['TIM:RANG'] = lambda hd, a: repr(10*self.timescale)
+        h['ACQ:POIN'] = lambda hd, a: str(self.points())
+        h['ACQ:SEGM:STAT'] = self.flag('segmented')
+        h['ACQ:COUN'] = self.acquire_count
+        h['EXP:WAV:FAST'] = self.flag('fastexport')
+        h['FORM:DATA'] = self.set_format
+        h['FORM'] = self.set_format
+        h['FORM:BORD'] = lambda hd, a: None
+        h['RUN'] = self.run
+        h['STOP'] = self.stop
+        h['SING'] = self.single
+        h['RUNS'] = self.single
+        h['SYST:DISP:UPD'] = lambda hd, a: None
+        h['HCOP:DEST'] = lambda hd, a: None
+        h['HCOP:DEV:LANG'] = lambda hd, a: None
+        h['HCOP:DEV:INV'] = lambda hd, a: None
+        h['HCOP:IMM'] = lambda hd, a: None
+        h['MMEM:NAME'] = lambda hd, a: None
+        h['MEAS#:CLE'] = self.clear_meas
+        h['MEAS#:LTM:COUN'] = lambda hd, a: None
+        h['MEAS#:LTM:STAT'] = lambda hd, a: None
+        h['MEAS#:STAT:ENAB'] = self.enable_meas
+        h['MEAS#:RES:AVG'] = self.meas_result('avg')
+        h['MEAS#:RES:STDD'] = self.meas_result('std')
+        h['MEAS#:RES:EVTC'] = self.meas_result('count')
+
+    def channel_value(self, store):
+        def handler(header, args):
+            if header.endswith('?'):
+                return repr(store[channel_of(header)])
+            store[channel_of(header)] = parse_value(args)
+        return handler
+
+    def channel_range(self, header, args):
+        c = channel_of(header)
+        if header.endswith('?'):
+            return repr(10*self.scale[c])
+        self.scale[c] = parse_value(args)/10
+
+    def channel_state(self, header, args):
+        c = channel_of(header)
+        if header.endswith('?'):
+            return '1' if self.state[c] else '0'
+        self.state[c] = args.upper() in ('ON', '1')
+
+    def scalar(self, name):
+        def handler(header, args):
+            if header.endswith('?'):
+                return repr(getattr(self, name))
+            setattr(self, name, parse_value(args))
+        return handler
+
+    def flag(self, name):
+        def handler(header, args):
+            if header.endswith('?'):
+                return '1' if getattr(self, name) else '0'
+            setattr(self, name, args.upper() in ('ON', '1'))
+        return handler
+
+    def acquire_count(self, header, args):
+        if header.endswith('?'):
+            return str(self.acq_count)
+        self.acq_count = int(parse_value(args))
+
+    def set_format(self, header, args):
+        if header.endswith('?'):
+            return self.data_format
+        self.data_format = args.replace(' ', '').upper()
+
+    def points(self):
+        return int(round(10*self.timescale/self.resolution))
+
+    def time_axis(self):
+        return -5*self.timescale+self.timedelay+self.resolution*np.arange(self.points())
+
+    def data_header(self, header, args):
+        start = -5*self.timescale+self.timedelay
+        return '{!r},{!r},{},1'.format(start, start+10*self.timescale, self.points())
+
+    ## Acquires count triggers, the history holds the screen-clipped waveforms
+    def acquire(self, count):
+        time.sleep(count/bench.trigger_rate)
+        wfs = bench.pulses(self.time_axis(), count, polarity=1)
+        c = 2
+        top = self.offset[c]-self.position[c]*self.scale[c]+5*self.scale[c]
+        bottom = top-10*self.scale[c]
+        self.history = np.clip(wfs, bottom, top)
+
+    def single(self, header, args):
+        self.acquire(self.acq_count if self.segmented else 1)
+
+    def run(self, header, args):
+        self.running_since = time.time()
+
+    def stop(self, header, args):
+        if self.running_since is not None:
+            events = int((time.time()-self.running_since)*bench.trigger_rate)
+            for g in self.meas_events:
+                self.meas_events[g] += events
+            self.running_since = None
+        self.acquire(1)
+
+    def clear_meas(self, header, args):
+        self.meas_events[int(re.search(r'MEAS(\d)', header).group(1))] = 0
+
+    def next_error(self, header, args):
+        return self.error_queue.pop(0) if self.error_queue else '0,"No error"'
+
+    def all_errors(self, header, args):
+        errors, self.error_queue[:] = list(self.error_queue), []
+        return ','.join(errors) if errors else '0,"No error"'
+
+    def enable_meas(self, header, args):
+        self.meas_enabled.add(int(re.search(r'MEAS(\d)', header).group(1)))
+
+    ## Statistics of the pre-set groups: delay, slew, amplitude, area, low
+    def meas_result(self, field):
+        def handler(header, args):
+            group = int(re.search(r'MEAS(\d)', header).group(1))
+            if field == 'count':
+                return str(self.meas_events[group])
+            amp = bench.amplitude()
+            values = {1: (1.2e-9, 15e-12+2e-13/max(amp, 1e-4)),
+                      2: (amp/150e-12, 0.05*amp/150e-12+1e6),
+                      3: (amp, 0.05*amp+1e-3),
+                      4: (amp*500e-12, 0.05*amp*500e-12+1e-13),
+                      5: (0.0, 1e-3)}[group]
+            return repr(float(values[0] if field == 'avg' else values[1]))
+        return handler
+
+    def waveform_data(self, header, args):
+        c = channel_of(header)
+        if len(self.history) == 0:
+            self.acquire(1)
+        wfs = self.history if (self.segmented and self.fastexport) else self.history[-1:]
+        if c != 2:
+            wfs = bench.rng.standard_normal(wfs.shape)*1e-3
+        data = wfs.ravel()
+        if self.data_format.startswith('ASC'):
+            return ','.join('{:.6e}'.format(x) for x in data)
+        if self.data_format == 'REAL,32':
+            return data.astype('<f4').tobytes()
+        levels = {'INT,8': 253, 'INT,16': 65024}[self.data_format]
+        gain = 10*self.scale[c]/levels
+        centre = self.offset[c]-self.position[c]*self.scale[c]
+        raw = np.clip(np.round((data-centre)/gain), -(levels//2), levels//2)
+        return raw.astype('i1' if self.data_format == 'INT,8' else '<i2').tobytes()
+
+    def handle_bytes(self, command):
+        reply = self.handle(command)
+        return reply.encode() if isinstance(reply, str) else reply
+
+    def write_str(self, command):
+        self.write(command)
+
+    def write_str_with_opc(self, command, timeout=None):
+        self.write(command)
+
+    write_with_opc = write_str_with_opc
+
+    def query_str(self, command):
+        return self.query(command)
+
+    def query_bin_block(self, command):
+        reply = self.handle_bytes(command)
+        self.latency_delay(normalise(command)[0], len(command)+len(reply))
+        return reply
+
+    def read_file_from_instrument_to_pc(self, source, destination):
+        self.latency_delay('MMEM:DATA', 50000)
+
+### Keithley 2410 SMU behind the pyvisa resource API
+class SimulatedKeithleySession(SimulatedSession):
+    latency_name = 'keithley'
+    idn = 'KEITHLEY INSTRUMENTS INC.,MODEL 2410,0000000,C34 (simulated)'
+
+    def __init__(self):
+        super().__init__()
+        self.level = 0.0
+        self.previous_level = 0.0
+        self.level_time = time.time()
+        self.compliance = 105e-6
+        self.source_delay = 0.0
+        self.terminal = 'FRON'
+        self.arm_source = 'IMM'
+        self.arm_count = 1
+        self.arm_timer = 0.1
+        self.trace_points = 100
+        self.trace = []
+        self.buffer_start = None
+        self.start_time = time.time()
+        bench.smu_present = True
+        h = self.handlers
+        h['*IDN'] = lambda hd, a: self.idn
+        h['*OPC'] = self.operation_complete
+        h['SENS:FUNC'] = lambda hd, a: None
+        h['SOUR:VOLT:RANG'] = lambda hd, a: None
+        h['SENS:CURR:PROT:LEV'] = self.set_compliance
+        h['SENS:CURR:PROT:TRIP'] = lambda hd, a: '1' if self.sample()[2] & 0x8 else '0'
+        h['OUTP#:STAT'] = self.output
+        h['OUTP:STAT'] = self.output
+        h['ROUT:TERM'] = self.route
+        h['SOUR:VOLT:LEV:IMM:AMPL'] = self.set_level
+        h['SOUR:VOLT:LEV'] = self.set_level
+        h['SOUR:DEL'] = self.set_delay
+        h['SOUR:DEL:AUTO'] = lambda hd, a: None
+        h['READ'] = lambda hd, a: self.format_reading(*self.sample(wait=True))
+        h['INIT'] = self.initiate
+        h['FETC'] = lambda hd, a: self.format_reading(*self.sample())
+        h['TRAC:CLE'] = lambda hd, a: self.trace.clear()
+        h['TRAC:POIN'] = self.set_trace_points
+        h['TRAC:FEED'] = lambda hd, a: None
+        h['TRAC:FEED:CONT'] = lambda hd, a: None
+        h['TRAC:DATA'] = self.trace_data
+        h['ARM:SOUR'] = self.set_arm('arm_source', str)
+        h['ARM:TIM'] = self.set_arm('arm_timer', parse_value)
+        h['ARM:COUN'] = self.set_arm('arm_count', lambda a: int(parse_value(a)))
+        h['TRIG:COUN'] = lambda hd, a: None
+
+    def output(self, header, args):
+        if header.endswith('?'):
+            return '1' if bench.output_on else '0'
+        bench.output_on = args.upper() in ('ON', '1')
+        bench.bias = self.level if bench.output_on else 0.0
+
+    def route(self, header, args):
+        if header.endswith('?'):
+            return self.terminal
+        self.terminal = args.upper()[:4]
+
+    def set_compliance(self, header, args):
+        self.compliance = parse_value(args)
+
+    def set_delay(self, header, args):
+        self.source_delay = parse_value(args)
+
+    def set_level(self, header, args):
+        self.previous_level = self.level
+        self.level = parse_value(args)
+        self.level_time = time.time()
+        if bench.output_on:
+            bench.bias = self.level
+
+    def set_arm(self, name, convert):
+        def handler(header, args):
+            setattr(self, name, convert(args.upper() if convert is str else args))
+        return handler
+
+    def set_trace_points(self, header, args):
+        self.trace_points = int(parse_value(args))
+
+    ## Returns (voltage, current, status, timestamp) at time t, with the charging transient
+    def sample(self, t=None, wait=False):
+        if wait and self.source_delay:
+            time.sleep(self.source_delay)
+        if t is None:
+            t = time.time()
+        voltage = bench.bias
+        current = bench.leakage(voltage)
+        step = self.level-self.previous_level
+        current += 2e-10*step/0.05*np.exp(-max(t-self.level_time, 0)/0.05)   # 200 pF, 50 ms
+        current *= 1+0.01*bench.rng.standard_normal()
+        status = 0
+        if abs(current) > self.compliance:
+            current = np.sign(current)*self.compliance
+            status |= 0x8
+        return voltage, current, status, t-self.start_time
+
+    def format_reading(self, voltage, current, status, timestamp):
+        return '{:+.6E},{:+.6E},+9.910000E+37,{:+.6E},{:+.6E}'.format(voltage, current, timestamp, status)
+
+    def initiate(self, header, args):
+        if self.arm_source == 'TIM':
+            self.buffer_start = time.time()
+
+    def operation_complete(self, header, args):
+        if self.buffer_start is not None:
+            done = self.buffer_start+self.arm_count*self.arm_timer
+            if done > time.time():
+                time.sleep(done-time.time())
+        return '1'
+
+    def trace_data(self, header, args):
+        if self.buffer_start is None:
+            return ''
+        count = min(self.arm_count, self.trace_points)
+        times = self.buffer_start+self.arm_timer*np.arange(count)
+        readings = [self.format_reading(*self.sample(t)) for t in times]
+        self.buffer_start = None
+        return ','.join(readings)
+
+### QD laser driver over RS232, replies are stale for a few reads after a write
+class SimulatedQDLaserSession(SimulatedSession):
+    latency_name = 'qd_laser'
+    stale_reads = 2
+
+    def __init__(self):
+        super().__init__()
+        self.registers = {'VGG': '0830', 'BIA': '0090', 'TMP': '2000', 'AT3': '4000',
+            'CKS': '3', 'TEC': '0', 'LDD': '0', 'ALM': '000',
+            'V3M': '3301', 'V5M': '4998'}
+        self.stale = {}                 # Register -> (old reply, reads left)
+
+    def monitor(self, register):
+        if register == 'TEM':
+            tec = self.registers['TEC'] == '1'
+            return '{:04d}'.format(int(self.registers['TMP'])+(1 if tec else 300))
+        if register == 'VGM':
+            return '-{:04d}'.format(int(self.registers['VGG'])-1)
+        if register == 'BIM':
+            return self.registers['BIA'] if self.registers['LDD'] == '1' else '0000'
+        return self.registers[register]
+
+    def write(self, command):
+        self.latency_delay(command[:3], len(command))
+        register, _, value = command.strip().partition('=')
+        for r in ('TEM', 'VGM', 'BIM', register):
+            self.stale[r] = (self.monitor(r), self.stale_reads)
+        self.registers[register] = value
+        bench.laser_on = self.registers['LDD'] == '1' and self.registers['CKS'] != '3'
+        bench.laser_bias = int(self.registers['BIA'])/10
+
+    def query(self, command):
+        register = command.strip().rstrip('?')
+        reply = self.monitor(register)
+        if register in self.stale:
+            old, left = self.stale[register]
+            if left > 0:
+                reply = old
+                self.stale[register] = (old, left-1)
+        self.latency_delay(register, len(command)+len(reply))
+        return reply+'\r\n'
+
+### Agilent MSO6104A over USBTMC, WORD format blocks read with read_raw
+class SimulatedAgilentSession(SimulatedSession):
+    latency_name = 'agilent'
+    idn = 'AGILENT TECHNOLOGIES,MSO6104A,MY44000509,05.50 (simulated)'
+    points = 1000
+
+    def __init__(self):
+        super().__init__()
+        self.scale = {c: 0.1 for c in range(1, 5)}
+        self.offset = {c: 0.0 for c in range(1, 5)}
+        self.timescale = 1e-9
+        self.timedelay = 3e-9
+        self.source = 1
+        self.pending = b''
+        self.waveforms = {}
+        h = self.handlers
+        h['*IDN'] = lambda hd, a: self.idn
+        h['*OPC'] = lambda hd, a: '1'
+        h['WAV:FORM'] = lambda hd, a: None
+        h['WAV:SOUR'] = self.set_source
+        h['WAV:PRE'] = self.preamble
+        h['WAV:DATA'] = self.data
+        h['SING'] = self.single
+        h['TER'] = lambda hd, a: '+1'
+        h['ACQ:TYPE'] = lambda hd, a: None
+        h['CHAN#:SCAL'] = self.channel_value(self.scale)
+        h['CHAN#:OFFS'] = self.channel_value(self.offset)
+        h['CHAN#:RANG'] = lambda hd, a: repr(8*self.scale[channel_of(hd)])
+        h['TIM:SCAL'] = self.set_timebase('timescale')
+        h['TIM:POS'] = self.set_timebase('timedelay')
+        h['SAVE:SET:STAR'] = lambda hd, a: '1'
+        h['REC:SET:STAR'] = lambda hd, a: '1'
+
+    def channel_value(self, store):
+        def handler(header, args):
+            if header.endswith('?'):
+                return repr(store[channel_of(header)])
+            store[channel_of(header)] = parse_value(args)
+        return handler
+
+    def set_timebase(self, name):
+        def handler(header, args):
+            if header.endswith('?'):
+                return repr(getattr(self, name))
+            setattr(self, name, parse_value(args))
+        return handler
+
+    def set_source(self, header, args):
+        self.source = channel_of(args.upper())
+
+    def scaling(self, c):
+        yinc = 8*self.scale[c]/(0xff00-0x0100)
+        return yinc, self.offset[c], 32768.0
+
+    def preamble(self, header, args):
+        yinc, yorg, yref = self.scaling(self.source)
+        xinc = 10*self.timescale/self.points
+        xorg = -5*self.timescale+self.timedelay
+        return '+1,+0,+{},+1,{!r},{!r},+0,{!r},{!r},{!r}'.format(self.points, xinc, xorg, yinc, yorg, yref)
+
+    def single(self, header, args):
+        time.sleep(1/bench.trigger_rate)
+        t = -5*self.timescale+self.timedelay+10*self.timescale/self.points*np.arange(self.points)
+        pulse = bench.pulses(t, 1, polarity=-1)[0]
+        self.waveforms = {c: (pulse if c == 1 else bench.pulses(t, 1, -1, 1e-3)[0]*0.2)
+            for c in range(1, 5)}
+
+    def data(self, header, args):
+        if not self.waveforms:
+            self.single(header, args)
+        yinc, yorg, yref = self.scaling(self.source)
+        codes = np.clip(np.round((self.waveforms[self.source]-yorg)/yinc+yref), 0x0100, 0xff00)
+        block = codes.astype('>u2').tobytes()
+        length = '{:08d}'.format(len(block)).encode()
+        self.pending = b'#8'+length+block+b'\n'
+
+    def read_raw(self):
+        data, self.pending = self.pending, b''
+        self.latency_delay('WAV:DATA', len(data))
+        return data
+
+### TTi QL355TP power supply behind the pyserial API
+class SimulatedSerial():
+
+    def __init__(self, *args, **kwargs):
+        self.buffer = b''
+        self.voltage = {1: 0.0, 2: 0.0}
+        self.on = {1: False, 2: False}
+
+    def isOpen(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        command = data.decode().strip()
+        latency_models['tti'].delay(command, len(data))
+        reply = None
+        if command == '*IDN?':
+            reply = 'THURLBY THANDAR, QL355TP, 000000, 1.00 (simulated)'
+        elif re.match(r'V\dO\?', command):
+            c = int(command[1])
+            reply = '{:.3f}V'.format(self.voltage[c] if self.on[c] else 0.0)
+        elif re.match(r'I\dO\?', command):
+            c = int(command[1])
+            reply = '{:.4f}A'.format(0.1*self.voltage[c]/12 if self.on[c] else 0.0)
+        elif re.match(r'V\d ', command):
+            self.voltage[int(command[1])] = float(command.split()[1])
+        elif command.startswith('OPALL'):
+            self.on = {1: command.endswith('1'), 2: command.endswith('1')}
+        elif re.match(r'OP\d ', command):
+            self.on[int(command[2])] = command.endswith('1')
+        if reply is not None:
+            self.buffer += (reply+'\r\n').encode()
+        return len(data)
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+### Standa XIMC motion controllers, stand-in for the pyximc module
+class Result():
+    Ok = 0
+    Error = -1
+
+class EnumerateFlags():
+    ENUMERATE_PROBE = 0x01
+    ENUMERATE_ALL_COM = 0x02
+    ENUMERATE_NETWORK = 0x04
+
+class get_position_t(Structure):
+    _fields_ = [('Position', c_int), ('uPosition', c_int), ('EncPosition', c_int)]
+
+class move_settings_t(Structure):
+    _fields_ = [('Speed', c_uint), ('uSpeed', c_uint), ('Accel', c_uint), ('Decel', c_uint),
+        ('AntiplaySpeed', c_uint), ('uAntiplaySpeed', c_uint), ('MoveFlags', c_uint)]
+
+class controller_name_t(Structure):
+    _fields_ = [('ControllerName', c_char*17), ('CtrlFlags', c_uint)]
+
+class status_t(Structure):
+    _fields_ = [('MoveSts', c_uint), ('MvCmdSts', c_uint), ('PWRSts', c_uint), ('EncSts', c_uint),
+        ('WindSts', c_uint), ('CurPosition', c_int), ('uCurPosition', c_int), ('EncPosition', c_int),
+        ('CurSpeed', c_int), ('uCurSpeed', c_int), ('Ipwr', c_int), ('Upwr', c_int),
+        ('Iusb', c_int), ('Uusb', c_int), ('CurT', c_int), ('Flags', c_uint), ('GPIOFlags', c_uint)]
+
+class SimulatedAxis():
+
+    def __init__(self, name, axis):
+        self.name = name
+        self.axis = axis
+        self.position = 0
+        self.start = 0
+        self.target = 0
+        self.move_start = 0.0
+        self.speed = 2000.0             # Steps per second
+        self.settle = 0.02              # s after each move
+        self.direction = 1              # Of the last move, the play is taken up on that side
+
+    def duration(self):
+        return abs(self.target-self.start)/self.speed+self.settle
+
+    def current(self):
+        elapsed = time.time()-self.move_start
+        if elapsed >= self.duration():
+            return self.target
+        fraction = min(elapsed*self.speed/max(abs(self.target-self.start), 1), 1)
+        return int(round(self.start+(self.target-self.start)*fraction))
+
+    def move_to(self, target):
+        self.start = self.current()
+        self.target = int(target)
+        self.move_start = time.time()
+        if self.target != self.start:
+            self.direction = 1 if self.target > self.start else -1
+        play = bench.backlash.get(self.axis, 0) if self.direction < 0 else 0
+        bench.positions[self.axis] = self.target+play
+
+def obj(ref):
+    return getattr(ref, '_obj', ref)
+
+class SimulatedXimcLib():
+    names = [(b'8MT30-50', 'H'), (b'Axis 1', 'L'), (b'Axis 2', 'V')]
+
+    def __init__(self):
+        self.axes = {i+1: SimulatedAxis(name, axis) for i, (name, axis) in enumerate(self.names)}
+
+    def delay(self):
+        latency_models['ximc'].delay()
+
+    def ximc_version(self, sbuf):
+        sbuf.value = b'2.13.3 (simulated)'
+
+    def set_bindy_key(self, path):
+        return Result.Ok
+
+    def enumerate_devices(self, flags, hints):
+        return c_void_p(1)
+
+    def get_device_count(self, devenum):
+        return len(self.axes)
+
+    def get_device_name(self, devenum, index):
+        return 'xi-sim:///{}'.format(index+1).encode()
+
+    def get_enumerate_device_controller_name(self, devenum, index, name_ref):
+        obj(name_ref).ControllerName = self.names[index][0]
+        return Result.Ok
+
+    def open_device(self, name):
+        return int(name.decode().rsplit('/', 1)[1])
+
+    def close_device(self, ref):
+        return Result.Ok
+
+    def get_position(self, device_id, pos_ref):
+        self.delay()
+        obj(pos_ref).Position = self.axes[device_id].current()
+        obj(pos_ref).uPosition = 0
+        return Result.Ok
+
+    def get_move_settings(self, device_id, settings_ref):
+        obj(settings_ref).Speed = int(self.axes[device_id].speed)
+        return Result.Ok
+
+    def set_move_settings(self, device_id, settings_ref):
+        self.axes[device_id].speed = float(obj(settings_ref).Speed)
+        return Result.Ok
+
+    def get_status(self, device_id, status_ref):
+        self.delay()
+        status = obj(status_ref)
+        status.CurPosition = self.axes[device_id].current()
+        status.Upwr = 1200
+        status.Iusb = 200
+        return Result.Ok
+
+    def command_move(self, device_id, position, uposition):
+        self.delay()
+        self.axes[device_id].move_to(position)
+        return Result.Ok
+
+    def command_movr(self, device_id, step, ustep):
+        self.delay()
+        axis = self.axes[device_id]
+        axis.move_to(axis.target+step)
+        return Result.Ok
+
+    def command_wait_for_stop(self, device_id, interval):
+        axis = self.axes[device_id]
+        remaining = axis.move_start+axis.duration()-time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return Result.Ok
+
+    def command_stop(self, device_id):
+        axis = self.axes[device_id]
+        axis.target = axis.current()
+        axis.start = axis.target
+        play = bench.backlash.get(axis.axis, 0) if axis.direction < 0 else 0
+        bench.positions[axis.axis] = axis.target+play
+        return Result.Ok
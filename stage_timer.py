@@ -0,0 +1,61 @@
+import time,json,threading
+from contextlib import contextmanager
+
+### Accumulates wall time per scan stage (ramp, autoscale, ...) and counts finished points
+### Stages may be timed from several threads, with a pipelined scan their sum can exceed
+### the elapsed time. summary() is JSON-ready so runs can be compared between versions.
+class StageTimer():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+        self.points = 0
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter()-start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0)+seconds
+            self.counts[name] = self.counts.get(name, 0)+1
+
+    def point_done(self):
+        with self.lock:
+            self.points += 1
+
+    def summary(self):
+        elapsed = time.perf_counter()-self.start_time
+        with self.lock:
+            stages = {name: {'total': total, 'count': self.counts[name],
+                             'mean': total/self.counts[name], 'fraction': total/elapsed}
+                      for name, total in self.totals.items()}
+            points = self.points
+        return {'elapsed': elapsed, 'points': points,
+                'points_per_hour': 3600*points/elapsed if points else 0.0,
+                'stages': stages}
+
+    def report(self):
+        summary = self.summary()
+        lines = ['{} points in {:.1f} s, {:.0f} points/h'.format(
+            summary['points'], summary['elapsed'], summary['points_per_hour'])]
+        for name, stage in sorted(summary['stages'].items(), key=lambda x: -x[1]['total']):
+            lines.append('  {:<18} {:9.3f} s  {:5.1f} %  ({} x {:.4f} s)'.format(
+                name, stage['total'], 100*stage['fraction'], stage['count'], stage['mean']))
+        return '\n'.join(lines)
+
+    def save(self, file_name, **extra):
+        result = dict(extra)
+        result.update(self.summary())
+        with open(file_name, 'w') as f:
+            json.dump(result, f, indent=1)
+        return result
@@ -0,0 +1,104 @@
+import h5py
+import numpy as np
+
+from scope_timebase import Timebase
+
+### Chunked HDF5 container for the waveforms of one voltage scan
+### Layout:
+###   waveforms  (voltage, sample, trigger) float32, one chunk per voltage point
+###   voltage    (voltage,) set bias of every stored point
+###   features   (voltage, trigger) pulse_features of every trigger, if appended with features
+### The timebase (points, x_increment, x_origin) and the instrument settings are
+### stored once as file attributes. Points are appended as the scan runs and the
+### file is flushed after every point, so an interrupted scan stays readable.
+
+class WaveformStore():
+
+    def __init__(self, file_name, timebase, triggers, settings=None, dtype=np.float32, compression='gzip'):
+        self.file_name = file_name
+        self.file = h5py.File(file_name, 'w')
+        self.file.attrs['points'] = timebase.points
+        self.file.attrs['x_increment'] = timebase.x_increment
+        self.file.attrs['x_origin'] = timebase.x_origin
+        if settings is not None:
+            for key, value in settings.items():
+                self.file.attrs[key] = value
+        samples = timebase.points
+        self.waveforms = self.file.create_dataset('waveforms', shape=(0, samples, triggers),
+            maxshape=(None, samples, triggers), chunks=(1, samples, triggers),
+            dtype=dtype, compression=compression)
+        self.voltage = self.file.create_dataset('voltage', shape=(0,), maxshape=(None,), dtype=np.float64)
+        self.features = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.voltage.shape[0]
+
+    ## waveforms of shape (sample, trigger), e.g. AcquisitionBuffer.waveforms
+    ## features: structured array with one entry per trigger, from pulse_features.extract_features
+    def append(self, voltage, waveforms, features=None):
+        index = len(self)
+        self.waveforms.resize(index+1, axis=0)
+        self.voltage.resize(index+1, axis=0)
+        self.waveforms[index] = waveforms
+        self.voltage[index] = voltage
+        if features is not None:
+            if self.features is None:       # Points appended before without features stay NaN
+                missing = np.full(1, np.nan, dtype=features.dtype)[0]
+                self.features = self.file.create_dataset('features', shape=(index, len(features)),
+                    maxshape=(None, len(features)), dtype=features.dtype, fillvalue=missing)
+            self.features.resize(index+1, axis=0)
+            self.features[index] = features
+        self.file.flush()
+        return index
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+### Read side - only the requested voltage slices are loaded from disk
+class WaveformStoreReader():
+
+    def __init__(self, file_name):
+        self.file = h5py.File(file_name, 'r')
+        self.voltages = self.file['voltage'][:]
+        self.timebase = Timebase(self.file.attrs['points'], self.file.attrs['x_increment'],
+            self.file.attrs['x_origin'])
+        self.settings = dict(self.file.attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.voltages)
+
+    def __getitem__(self, index):
+        return self.file['waveforms'][index]
+
+    def index_of(self, voltage):
+        index, = np.where(np.isclose(self.voltages, voltage))
+        if len(index) == 0:
+            raise KeyError('Voltage {} V not in {}'.format(voltage, self.file.filename))
+        return index[0]
+
+    ## (sample, trigger) array of the point taken at the given bias
+    def read(self, voltage):
+        return self[self.index_of(voltage)]
+
+    ## Features stored with the point at the given bias, None if the scan did not extract any
+    def read_features(self, voltage):
+        if 'features' not in self.file:
+            return None
+        return self.file['features'][self.index_of(voltage)]
+
+    def close(self):
+        self.file.close()